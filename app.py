@@ -7,25 +7,55 @@ Track B: Magenta ML models (future upgrade)
 """
 
 from fastapi import FastAPI, UploadFile, File, HTTPException, WebSocket, WebSocketDisconnect
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import HTMLResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 import tempfile
 import os
 import random
+import re
 import json
 import base64
+import codecs
 import asyncio
 import subprocess
 import uuid
+import functools
+import hashlib
+import io
+import itertools
+import multiprocessing
+import queue
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from typing import Optional, List, Dict, Any
 from pathlib import Path
+from urllib.parse import quote
 from datetime import datetime
 
+import numpy as np
 import mido
 from mido import MidiFile, MidiTrack, Message, MetaMessage
 
+# Optional in-process FluidSynth binding (pip install pyfluidsynth). Without it
+# rendering falls back to one `fluidsynth` CLI process per request.
+try:
+    import fluidsynth
+except (ImportError, OSError):
+    fluidsynth = None
+
+# Optional fast JSON encoder (pip install orjson) for outbound WebSocket messages
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 app = FastAPI(
     title="PromptDJ - AI Music Generator",
     description="Local backend AI service for MIDI generation - Spectacles Ready",
@@ -35,28 +65,15 @@ app = FastAPI(
 # Get the directory where app.py is located
 BASE_DIR = Path(__file__).resolve().parent
 STATIC_DIR = BASE_DIR / "static"
-OUT_DIR = BASE_DIR / "out"
 SF2_DIR = BASE_DIR / "sf2"
 
-# Create output directory for rendered audio
-OUT_DIR.mkdir(exist_ok=True)
-
 # SoundFont path for FluidSynth
 SF2_PATH = SF2_DIR / "MuseScore_General.sf2"
 
-# Server URL - use 127.0.0.1 for Lens Studio Preview, network IP for real Spectacles
-# Set HOST_IP environment variable to override (e.g., export HOST_IP=172.20.10.3)
-import os
-HOST_IP = os.getenv("HOST_IP", "172.20.10.4")  # Default to localhost for local testing
-HOST_URL = f"http://{HOST_IP}:8123"
-
 # Mount static files
 if STATIC_DIR.exists():
     app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
 
-# Mount output directory for audio files
-app.mount("/out", StaticFiles(directory=str(OUT_DIR)), name="out")
-
 # Enable CORS for web UI access
 app.add_middleware(
     CORSMiddleware,
@@ -79,6 +96,7 @@ class GenerateRequest(BaseModel):
     density: float = 0.55       # 0..1 how many notes
     variation: float = 0.35     # 0..1 how wild/experimental
     octave_range: int = 2       # How many octaves to span
+    generator: str = "random"   # random (note by note) or numpy (batched, for long/bulk clips)
 
 
 class DrumifyRequest(BaseModel):
@@ -87,6 +105,7 @@ class DrumifyRequest(BaseModel):
     seed: Optional[int] = None
     style: str = "basic"        # basic, funk, jazz, electronic
     swing: float = 0.0          # 0..1 swing amount
+    loop_bars: Optional[int] = None  # repeat the first N bars (None: every bar varies)
 
 
 class StyleRequest(BaseModel):
@@ -215,93 +234,243 @@ def get_scale_notes(scale_name: str, base_octave: int = 4, octave_range: int = 2
     return notes
 
 
+# ============================================================================
+# STANDARD MIDI FILE ENCODER
+# ============================================================================
+#
+# Generators describe a track as a list of events in time order:
+#   (tick, type, data1, data2, channel)  channel message at absolute tick, e.g.
+#                                        (960, SMF_NOTE_ON, 60, 100, 0)
+#   (tick, raw)                          meta or sysex event, already encoded
+# and encode_smf_track() writes it straight to SMF bytes (delta times as
+# variable-length quantities, running status), without mido objects.
+
+SMF_NOTE_OFF = 0x80
+SMF_NOTE_ON = 0x90
+
+# Data bytes that follow each channel status (by high nibble)
+SMF_DATA_BYTES = {0x80: 2, 0x90: 2, 0xA0: 2, 0xB0: 2, 0xC0: 1, 0xD0: 1, 0xE0: 2}
+
+
+def encode_vlq(value: int) -> bytes:
+    """MIDI variable-length quantity: 7 bits per byte, high bit set on all but the last."""
+    out = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        out.append(0x80 | (value & 0x7F))
+        value >>= 7
+    out.reverse()
+    return bytes(out)
+
+
+def smf_meta(meta_type: int, data: bytes) -> bytes:
+    """Encode a meta event (without its delta time)."""
+    return bytes((0xFF, meta_type)) + encode_vlq(len(data)) + data
+
+
+def smf_track_header(tempo_bpm: float, name: str) -> list:
+    """Tempo, 4/4 time signature and track name events at tick 0."""
+    return [
+        (0, smf_meta(0x51, mido.bpm2tempo(tempo_bpm).to_bytes(3, "big"))),
+        (0, smf_meta(0x58, bytes((4, 2, 24, 8)))),  # 4/4, 24 clocks per click, 8 32nds per beat
+        (0, smf_meta(0x03, name.encode("latin-1"))),
+    ]
+
+
+def encode_smf_track(events, end_tick: int = 0) -> bytes:
+    """
+    Encode one track chunk (MTrk) from events in time order.
+    
+    end_of_track is added at the last event, or at end_tick if that is later
+    (trailing silence). Meta and sysex events reset running status.
+    """
+    out = bytearray()
+    last_tick = 0
+    running = None
+    for event in events:
+        tick = event[0]
+        delta = tick - last_tick
+        if delta < 0:
+            raise ValueError(f"MIDI events out of order at tick {tick}")
+        if delta < 0x80:
+            out.append(delta)
+        else:
+            out += encode_vlq(delta)
+        last_tick = tick
+        
+        if len(event) == 2:
+            out += event[1]
+            running = None
+            continue
+        
+        _, kind, data1, data2, channel = event
+        status = kind | channel
+        if status != running:
+            out.append(status)
+            running = status
+        out.append(data1)
+        if SMF_DATA_BYTES[kind] == 2:
+            out.append(data2)
+    
+    out += encode_vlq(max(0, end_tick - last_tick))
+    out += b"\xff\x2f\x00"
+    return b"MTrk" + struct.pack(">I", len(out)) + bytes(out)
+
+
+def encode_smf(tracks: List[bytes], ticks_per_beat: int = 480) -> bytes:
+    """Assemble a type 1 Standard MIDI File from encoded track chunks."""
+    return b"MThd" + struct.pack(">IHHH", 6, 1, len(tracks), ticks_per_beat) + b"".join(tracks)
+
+
+def smf_events_from_track(track, tick: int = 0, events: Optional[list] = None) -> tuple:
+    """
+    Convert a parsed mido track to encoder events (appended to events).
+    
+    Returns (events, tick) where tick is where the track ends, including the
+    delta of its end_of_track; end_of_track itself is left to the encoder.
+    """
+    if events is None:
+        events = []
+    for msg in track:
+        tick += msg.time
+        if msg.is_meta:
+            if msg.type != "end_of_track":
+                events.append((tick, bytes(msg.bytes())))
+        elif msg.type == "sysex":
+            data = bytes(msg.data)
+            events.append((tick, b"\xf0" + encode_vlq(len(data) + 1) + data + b"\xf7"))
+        else:
+            raw = msg.bytes()
+            events.append((tick, raw[0] & 0xF0, raw[1], raw[2] if len(raw) > 2 else 0, raw[0] & 0x0F))
+    return events, tick
+
+
 # ============================================================================
 # MIDI GENERATION FUNCTIONS
 # ============================================================================
 
-def generate_melody_midi(req: GenerateRequest) -> str:
-    """Generate a melodic MIDI file using probabilistic methods."""
-    if req.seed is not None:
-        random.seed(req.seed)
+# Note durations in ticks (480 = quarter note)
+MELODY_DURATIONS = [120, 240, 480, 720, 960]  # 16th, 8th, quarter, dotted quarter, half
+
+# Markov-ish movement (scale degree steps)
+MELODY_STEPS = [-3, -2, -1, 0, 1, 2, 3]
+MELODY_STEP_WEIGHTS = [0.05, 0.15, 0.25, 0.1, 0.25, 0.15, 0.05]  # Prefer stepwise motion
+
 
-    mid = MidiFile(ticks_per_beat=480)
-    track = MidiTrack()
-    mid.tracks.append(track)
+def build_melody_midi(req: GenerateRequest) -> bytes:
+    """Build a melodic MIDI file in memory (SMF bytes) using probabilistic methods."""
+    if req.generator == "numpy":
+        return build_melody_midi_numpy(req)
+    
+    # Private RNG so concurrent render jobs never share (or reseed) global state
+    rng = random.Random(req.seed)
 
     # Set tempo and time signature
-    tempo = mido.bpm2tempo(req.tempo_bpm)
-    track.append(MetaMessage("set_tempo", tempo=tempo, time=0))
-    track.append(MetaMessage("time_signature", numerator=4, denominator=4, time=0))
-    track.append(MetaMessage("track_name", name="AI Melody", time=0))
+    events = smf_track_header(req.tempo_bpm, "AI Melody")
 
     # Get scale notes
     scale_notes = get_scale_notes(req.scale, octave_range=req.octave_range)
     
-    # Note durations in ticks (480 = quarter note)
-    durations = [120, 240, 480, 720, 960]  # 16th, 8th, quarter, dotted quarter, half
-    
-    # Markov-ish movement (scale degree steps)
-    steps = [-3, -2, -1, 0, 1, 2, 3]
-    step_weights = [0.05, 0.15, 0.25, 0.1, 0.25, 0.15, 0.05]  # Prefer stepwise motion
+    durations = MELODY_DURATIONS
+    steps = MELODY_STEPS
+    step_weights = MELODY_STEP_WEIGHTS
 
     total_ticks = req.bars * 4 * 480  # bars * beats * ticks_per_beat
     current_tick = 0
     current_idx = len(scale_notes) // 2  # Start in middle of range
+    # Notes are written back to back: a skipped 16th only advances current_tick
+    track_tick = 0
 
     while current_tick < total_ticks:
         # Probabilistic note placement based on density
-        if random.random() > req.density:
+        if rng.random() > req.density:
             current_tick += 120  # Skip a 16th note
             continue
 
         # Choose duration
-        dur = random.choice(durations)
+        dur = rng.choice(durations)
         if current_tick + dur > total_ticks:
             dur = total_ticks - current_tick
 
         # Move through scale
-        step = random.choices(steps, weights=step_weights)[0]
-        if random.random() < req.variation:
-            step *= random.choice([1, 2])  # Bigger jumps occasionally
+        step = rng.choices(steps, weights=step_weights)[0]
+        if rng.random() < req.variation:
+            step *= rng.choice([1, 2])  # Bigger jumps occasionally
         
         current_idx = max(0, min(len(scale_notes) - 1, current_idx + step))
         pitch = scale_notes[current_idx]
 
         # Velocity with some variation
-        vel = random.randint(60, 100)
-        if random.random() < 0.1:  # Occasional accent
+        vel = rng.randint(60, 100)
+        if rng.random() < 0.1:  # Occasional accent
             vel = min(127, vel + 20)
 
-        # Note on
-        track.append(Message("note_on", note=pitch, velocity=vel, time=0))
-        # Note off
-        track.append(Message("note_off", note=pitch, velocity=0, time=dur))
+        # Note on, note off
+        events.append((track_tick, SMF_NOTE_ON, pitch, vel, 0))
+        track_tick += dur
+        events.append((track_tick, SMF_NOTE_OFF, pitch, 0, 0))
 
         current_tick += dur
 
-    # End of track
-    track.append(MetaMessage("end_of_track", time=0))
+    return encode_smf([encode_smf_track(events)])
 
-    # Save to temp file
-    fd, path = tempfile.mkstemp(suffix=".mid", prefix="melody_")
-    os.close(fd)
-    mid.save(path)
-    return path
 
+def build_melody_midi_numpy(req: GenerateRequest) -> bytes:
+    """
+    Batched melody generator: every random draw for the clip is one NumPy array.
+    
+    Each event is a note (with probability density) or a 16th rest; there are
+    never more events than 16ths, so that many are drawn up front. Onsets come
+    from a cumulative sum of the event lengths, and the last note is clipped to
+    the end of the clip. The melody is a random walk over the scale that
+    reflects off the ends of the range. Unlike the note-by-note generator,
+    rests are kept as silence, so a clip always lasts exactly `bars` bars.
+    The same seed gives the same clip (np.random.default_rng).
+    """
+    rng = np.random.default_rng(req.seed)
+
+    scale_notes = np.array(get_scale_notes(req.scale, octave_range=req.octave_range))
+    total_ticks = req.bars * 4 * 480
+    n = total_ticks // 120
+
+    # All draws for the clip at once
+    is_note = rng.random(n) < req.density
+    durs = rng.choice(MELODY_DURATIONS, size=n)
+    steps = rng.choice(MELODY_STEPS, size=n, p=MELODY_STEP_WEIGHTS)
+    jumps = np.where(rng.random(n) < req.variation, rng.integers(1, 3, size=n), 1)  # Bigger jumps occasionally
+    vels = rng.integers(60, 101, size=n)
+    vels = np.where(rng.random(n) < 0.1, np.minimum(127, vels + 20), vels)  # Occasional accent
+
+    # Timeline: a rest lasts a 16th; keep the events that start inside the clip
+    lengths = np.where(is_note, durs, 120)
+    starts = np.cumsum(lengths) - lengths
+    inside = starts < total_ticks
+    ends = np.minimum(starts + lengths, total_ticks)
+
+    # Scale walk, folded back into the range (reflecting, so no clamped runs)
+    top = len(scale_notes) - 1
+    walk = len(scale_notes) // 2 + np.cumsum(np.where(is_note, steps * jumps, 0))
+    if top > 0:
+        walk = top - np.abs(np.mod(walk, 2 * top) - top)
+    else:
+        walk = np.zeros_like(walk)
+
+    # Encoder rows, note_on/note_off interleaved: (tick, type, note, velocity, channel)
+    notes = is_note & inside
+    rows = np.zeros((2 * int(notes.sum()), 5), dtype=np.int64)
+    rows[0::2, 0], rows[1::2, 0] = starts[notes], ends[notes]
+    rows[0::2, 1], rows[1::2, 1] = SMF_NOTE_ON, SMF_NOTE_OFF
+    rows[:, 2] = np.repeat(scale_notes[walk[notes]], 2)
+    rows[0::2, 3] = vels[notes]
 
-def generate_drums_midi(req: DrumifyRequest) -> str:
-    """Generate a drum pattern MIDI file."""
-    if req.seed is not None:
-        random.seed(req.seed)
+    # Trailing rests keep the clip length
+    events = smf_track_header(req.tempo_bpm, "AI Melody") + [tuple(row) for row in rows.tolist()]
+    return encode_smf([encode_smf_track(events, end_tick=total_ticks)])
 
-    mid = MidiFile(ticks_per_beat=480)
-    track = MidiTrack()
-    mid.tracks.append(track)
 
-    tempo = mido.bpm2tempo(req.tempo_bpm)
-    track.append(MetaMessage("set_tempo", tempo=tempo, time=0))
-    track.append(MetaMessage("time_signature", numerator=4, denominator=4, time=0))
-    track.append(MetaMessage("track_name", name="AI Drums", time=0))
+def build_drums_midi(req: DrumifyRequest) -> bytes:
+    """Build a drum pattern MIDI file in memory (SMF bytes)."""
+    rng = random.Random(req.seed)
 
     pattern = DRUM_PATTERNS.get(req.style, DRUM_PATTERNS["basic"])
     ticks_per_16th = 480 // 4  # 120 ticks
@@ -314,20 +483,30 @@ def generate_drums_midi(req: DrumifyRequest) -> str:
 
     # Collect all drum hits with their times
     events = []
-    for bar in range(req.bars):
+    loop_bars = min(req.loop_bars or req.bars, req.bars)
+    for bar in range(loop_bars):
         for step in range(16):
             tick = (bar * 16 + step) * ticks_per_16th + get_swing_offset(step)
             
             for drum_name, hits in pattern.items():
                 if hits[step % len(hits)]:
                     # Add some probability for variation
-                    if random.random() < 0.95:  # 95% chance to play
+                    if rng.random() < 0.95:  # 95% chance to play
                         note = DRUM_MAP.get(drum_name, 36)
-                        vel = random.randint(80, 110)
+                        vel = rng.randint(80, 110)
                         # Ghost notes occasionally
-                        if random.random() < 0.1:
-                            vel = random.randint(40, 60)
+                        if rng.random() < 0.1:
+                            vel = rng.randint(40, 60)
                         events.append((tick, note, vel))
+    
+    # Repeat the generated loop over the remaining bars (swing never pushes a
+    # hit past its bar, so every event belongs to bar tick // ticks_per_bar)
+    ticks_per_bar = 16 * ticks_per_16th
+    loop = list(events)
+    for bar in range(loop_bars, req.bars):
+        shift = (bar - bar % loop_bars) * ticks_per_bar
+        events.extend((tick + shift, note, vel) for tick, note, vel in loop
+                      if tick // ticks_per_bar == bar % loop_bars)
 
     # Sort by time and write to track
     events.sort(key=lambda x: x[0])
@@ -335,75 +514,65 @@ def generate_drums_midi(req: DrumifyRequest) -> str:
     # Build list of all MIDI messages with absolute times
     midi_events = []
     for tick, note, vel in events:
-        midi_events.append((tick, "on", note, vel))
-        midi_events.append((tick + 60, "off", note, 0))  # Short drum hit
+        midi_events.append((tick, SMF_NOTE_ON, note, vel, 9))
+        midi_events.append((tick + 60, SMF_NOTE_OFF, note, 0, 9))  # Short drum hit
     
     # Sort all events by absolute time
     midi_events.sort(key=lambda x: x[0])
     
-    # Convert to delta times
-    last_tick = 0
-    for abs_tick, event_type, note, vel in midi_events:
-        delta = max(0, abs_tick - last_tick)  # Ensure non-negative delta
-        if event_type == "on":
-            track.append(Message("note_on", note=note, velocity=vel, time=delta, channel=9))
-        else:
-            track.append(Message("note_off", note=note, velocity=0, time=delta, channel=9))
-        last_tick = abs_tick
+    return encode_smf([encode_smf_track(smf_track_header(req.tempo_bpm, "AI Drums") + midi_events)])
 
-    track.append(MetaMessage("end_of_track", time=0))
 
-    fd, path = tempfile.mkstemp(suffix=".mid", prefix="drums_")
-    os.close(fd)
-    mid.save(path)
-    return path
+def midi_to_bytes(mid: MidiFile) -> bytes:
+    """Serialize a MIDI file to Standard MIDI File bytes without touching disk."""
+    buf = io.BytesIO()
+    mid.save(file=buf)
+    return buf.getvalue()
 
 
-def continue_midi_file(input_path: str) -> str:
-    """Continue/extend a MIDI file by analyzing and extending patterns."""
-    mid = MidiFile(input_path)
-    out = MidiFile(ticks_per_beat=mid.ticks_per_beat)
+def continue_midi_bytes(midi_data: bytes) -> bytes:
+    """Continue/extend a MIDI file (SMF bytes) by analyzing and extending patterns."""
+    mid = MidiFile(file=io.BytesIO(midi_data))
+    tracks = []
 
     for orig_track in mid.tracks:
-        new_track = MidiTrack()
-        out.tracks.append(new_track)
-        
         # Copy original track
-        new_track.extend(orig_track)
+        events, tick = smf_events_from_track(orig_track)
         
         # Analyze the last portion and create variation
         note_events = [msg for msg in orig_track if msg.type in ("note_on", "note_off")]
         
         if len(note_events) > 20:
-            # Take last ~25% of notes and create variation
+            # Take last ~25% of notes and create variation, played after the original
             tail_start = int(len(note_events) * 0.75)
             tail = note_events[tail_start:]
             
             for msg in tail:
+                tick += msg.time
                 if msg.type == "note_on" and msg.velocity > 0:
                     # Slight pitch and velocity variation
                     new_pitch = msg.note + random.choice([-2, -1, 0, 0, 1, 2])
                     new_pitch = max(0, min(127, new_pitch))
                     new_vel = max(1, min(127, msg.velocity + random.randint(-10, 10)))
-                    new_track.append(msg.copy(note=new_pitch, velocity=new_vel))
+                    events.append((tick, SMF_NOTE_ON, new_pitch, new_vel, msg.channel))
+                elif msg.type == "note_on":
+                    events.append((tick, SMF_NOTE_ON, msg.note, 0, msg.channel))
                 else:
-                    new_track.append(msg.copy())
+                    events.append((tick, SMF_NOTE_OFF, msg.note, msg.velocity, msg.channel))
+        
+        tracks.append(encode_smf_track(events, end_tick=tick))
 
-    fd, path = tempfile.mkstemp(suffix=".mid", prefix="continued_")
-    os.close(fd)
-    out.save(path)
-    return path
+    return encode_smf(tracks, mid.ticks_per_beat)
 
 
-def humanize_midi_file(input_path: str, req: StyleRequest) -> str:
-    """Apply humanization (timing/velocity variation) to a MIDI file."""
-    mid = MidiFile(input_path)
-    out = MidiFile(ticks_per_beat=mid.ticks_per_beat)
+def humanize_midi_bytes(midi_data: bytes, req: StyleRequest) -> bytes:
+    """Apply humanization (timing/velocity variation) to a MIDI file (SMF bytes)."""
+    mid = MidiFile(file=io.BytesIO(midi_data))
+    tracks = []
 
     for orig_track in mid.tracks:
-        new_track = MidiTrack()
-        out.tracks.append(new_track)
-        
+        events = []
+        tick = 0
         for msg in orig_track:
             if msg.type == "note_on" and msg.velocity > 0:
                 # Timing variation
@@ -414,14 +583,14 @@ def humanize_midi_file(input_path: str, req: StyleRequest) -> str:
                 vel_offset = int(random.gauss(0, req.velocity_variation * 15))
                 new_vel = max(1, min(127, msg.velocity + vel_offset))
                 
-                new_track.append(msg.copy(time=new_time, velocity=new_vel))
+                tick += new_time
+                events.append((tick, SMF_NOTE_ON, msg.note, new_vel, msg.channel))
             else:
-                new_track.append(msg.copy())
+                events, tick = smf_events_from_track([msg], tick, events)
+        
+        tracks.append(encode_smf_track(events, end_tick=tick))
 
-    fd, path = tempfile.mkstemp(suffix=".mid", prefix="humanized_")
-    os.close(fd)
-    out.save(path)
-    return path
+    return encode_smf(tracks, mid.ticks_per_beat)
 
 
 # ============================================================================
@@ -460,21 +629,28 @@ def api_info():
             "POST /drums - Generate drum pattern MIDI", 
             "POST /continue - Continue/extend uploaded MIDI",
             "POST /style - Apply humanization to uploaded MIDI",
+            "GET /stats - Render cache counters",
             "GET /docs - Interactive API documentation",
         ]
     }
 
 
+def midi_response(midi_data: bytes, filename: str) -> Response:
+    """Return SMF bytes as a .mid download, straight from memory."""
+    quoted = quote(filename)
+    if quoted == filename:
+        disposition = f'attachment; filename="{filename}"'
+    else:
+        disposition = f"attachment; filename*=utf-8''{quoted}"
+    return Response(midi_data, media_type="audio/midi", headers={"Content-Disposition": disposition})
+
+
 @app.post("/generate")
 def generate(req: GenerateRequest):
     """Generate a new melody MIDI file."""
     try:
-        path = generate_melody_midi(req)
-        return FileResponse(
-            path, 
-            media_type="audio/midi", 
-            filename=f"melody_{req.scale}_{req.tempo_bpm}bpm.mid"
-        )
+        midi_data = generate_midi_bytes(req)
+        return midi_response(midi_data, f"melody_{req.scale}_{req.tempo_bpm}bpm.mid")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -483,42 +659,25 @@ def generate(req: GenerateRequest):
 def drums(req: DrumifyRequest):
     """Generate a drum pattern MIDI file."""
     try:
-        path = generate_drums_midi(req)
-        return FileResponse(
-            path,
-            media_type="audio/midi",
-            filename=f"drums_{req.style}_{req.tempo_bpm}bpm.mid"
-        )
+        midi_data = generate_drums_bytes(req)
+        return midi_response(midi_data, f"drums_{req.style}_{req.tempo_bpm}bpm.mid")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/continue")
-async def continue_midi(file: UploadFile = File(...)):
+def continue_midi(file: UploadFile = File(...)):
     """Upload a MIDI file and get an extended version."""
     try:
-        data = await file.read()
-        fd_in, path_in = tempfile.mkstemp(suffix=".mid", prefix="upload_")
-        os.close(fd_in)
-        with open(path_in, "wb") as f:
-            f.write(data)
-
-        path_out = continue_midi_file(path_in)
-        
-        # Cleanup input
-        os.unlink(path_in)
-        
-        return FileResponse(
-            path_out,
-            media_type="audio/midi",
-            filename=f"continued_{file.filename}"
-        )
+        data = file.file.read()
+        midi_data = continue_midi_bytes(data)
+        return midi_response(midi_data, f"continued_{file.filename}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/style")
-async def style(
+def style(
     file: UploadFile = File(...),
     humanize: float = 0.3,
     velocity_variation: float = 0.2,
@@ -526,467 +685,2861 @@ async def style(
 ):
     """Apply humanization/style transformation to uploaded MIDI."""
     try:
-        data = await file.read()
-        fd_in, path_in = tempfile.mkstemp(suffix=".mid", prefix="upload_")
-        os.close(fd_in)
-        with open(path_in, "wb") as f:
-            f.write(data)
-
+        data = file.file.read()
         req = StyleRequest(
             humanize=humanize,
             velocity_variation=velocity_variation,
             swing=swing
         )
-        path_out = humanize_midi_file(path_in, req)
-        
-        # Cleanup input
-        os.unlink(path_in)
-        
-        return FileResponse(
-            path_out,
-            media_type="audio/midi",
-            filename=f"styled_{file.filename}"
-        )
+        midi_data = humanize_midi_bytes(data, req)
+        return midi_response(midi_data, f"styled_{file.filename}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 # ============================================================================
-# WEBSOCKET FOR SPECTACLES
+# AUDIO CODECS (WebSocket transport)
 # ============================================================================
-
-class ConnectionManager:
-    """Manages WebSocket connections for Spectacles clients."""
+#
+# Decoder spec. Every codec decodes to mono PCM16 at the audio_start sample_rate;
+# decode sample_count samples and drop any padding after them. Chunks are always
+# cut on whole codec frames, so each chunk decodes on its own.
+#
+# "pcm16"      Frame = 2 bytes: one int16 little-endian sample.
+#
+# "mulaw"      Frame = 1 byte: ITU-T G.711 mu-law (2:1). For byte b:
+#                  u = ~b & 0xFF; e = (u >> 4) & 7; m = u & 0x0F
+#                  s = (((m << 3) + 0x84) << e) - 0x84
+#                  sample = -s if u & 0x80 else s
+#
+# "ima_adpcm"  Frame = one block of IMA_BLOCK_ALIGN bytes (~4:1), laid out like
+#              mono IMA ADPCM in WAV files:
+#                  bytes 0-1  int16 LE: predictor, also the block's first sample
+#                  byte  2    step index (0-88)
+#                  byte  3    reserved (0)
+#                  bytes 4-   4-bit codes, low nibble first; one sample each
+#              For each code c, with step = IMA_STEP_TABLE[index]:
+#                  diff = step >> 3
+#                  if c & 4: diff += step
+#                  if c & 2: diff += step >> 1
+#                  if c & 1: diff += step >> 2
+#                  predictor += -diff if c & 8 else diff   (clamp to int16)
+#                  index += IMA_INDEX_TABLE[c & 7]           (clamp to 0-88)
+#                  sample = predictor
+#              Blocks do not depend on each other.
+
+IMA_STEP_TABLE = np.array([
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+    50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230,
+    253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963,
+    1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327,
+    3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442,
+    11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794,
+    32767,
+], dtype=np.int32)
+IMA_INDEX_TABLE = np.array([-1, -1, -1, -1, 2, 4, 6, 8], dtype=np.int32)
+
+# 256-byte blocks: 505 samples (~10 ms at 48 kHz) each
+IMA_BLOCK_ALIGN = 256
+IMA_SAMPLES_PER_BLOCK = (IMA_BLOCK_ALIGN - 4) * 2 + 1
+
+MULAW_BIAS = 0x84
+MULAW_CLIP = 8158  # Largest magnitude on the 14-bit scale the encoder works in (saturates)
+
+
+class AudioCodec:
+    """Uncompressed PCM16; the base the compact codecs override."""
     
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-        self.client_states: Dict[str, Dict[str, Any]] = {}
-    
-    async def connect(self, websocket: WebSocket, client_id: str):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-        self.client_states[client_id] = {
-            "connected_at": datetime.now().isoformat(),
-            "tempo_bpm": 120,
-            "scale": "C_major",
-            "density": 0.55,
-            "variation": 0.35,
-            "drum_style": "techno",
-            "swing": 0.0
-        }
-        print(f"🕶️ Spectacles client connected: {client_id}")
+    name = "pcm16"
+    frame_bytes = 2     # Chunks are cut on multiples of this
+    frame_samples = 1   # Samples carried by one frame
     
-    def disconnect(self, websocket: WebSocket, client_id: str):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-        if client_id in self.client_states:
-            del self.client_states[client_id]
-        print(f"🕶️ Spectacles client disconnected: {client_id}")
+    def encode(self, samples: np.ndarray) -> bytes:
+        """Encode int16 samples (a whole number of frames, padded by the caller)."""
+        return samples.astype("<i2").tobytes()
     
-    async def send_json(self, websocket: WebSocket, data: dict):
-        try:
-            await websocket.send_json(data)
-        except Exception as e:
-            print(f"Error sending JSON to client: {e}")
-            raise  # Re-raise to let caller handle
+    def decode(self, data: bytes) -> np.ndarray:
+        return np.frombuffer(data, dtype="<i2")
     
-    async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            try:
-                await connection.send_json(message)
-            except:
-                pass
+    def describe(self) -> dict:
+        return {"name": self.name, "frame_bytes": self.frame_bytes, "frame_samples": self.frame_samples}
 
 
-manager = ConnectionManager()
-
+class MuLawCodec(AudioCodec):
+    """G.711 mu-law, 8 bits per sample."""
+    
+    name = "mulaw"
+    frame_bytes = 1
+    
+    def encode(self, samples: np.ndarray) -> bytes:
+        s = samples.astype(np.int32) >> 2
+        sign = np.where(s < 0, 0x80, 0)
+        s = np.minimum(np.abs(s), MULAW_CLIP) + (MULAW_BIAS >> 2)
+        exponent = np.clip(np.floor(np.log2(s)).astype(np.int32) - 5, 0, 7)
+        mantissa = (s >> (exponent + 1)) & 0x0F
+        return (~(sign | (exponent << 4) | mantissa) & 0xFF).astype(np.uint8).tobytes()
+    
+    def decode(self, data: bytes) -> np.ndarray:
+        u = ~np.frombuffer(data, dtype=np.uint8).astype(np.int32) & 0xFF
+        exponent = (u >> 4) & 7
+        s = (((u & 0x0F) << 3) + MULAW_BIAS << exponent) - MULAW_BIAS
+        return np.where(u & 0x80, -s, s).astype(np.int16)
 
-# ============================================================================
-# MIDI TO AUDIO RENDERING (FluidSynth)
-# ============================================================================
 
-def render_midi_to_wav(midi_path: str) -> str:
+class ImaAdpcmCodec(AudioCodec):
     """
-    Render a MIDI file to WAV using FluidSynth.
-    Returns the path to the generated WAV file.
-    """
-    if not SF2_PATH.exists():
-        raise RuntimeError(f"SoundFont not found: {SF2_PATH}")
+    IMA ADPCM, 4 bits per sample in self-contained blocks.
     
-    if not Path(midi_path).exists():
-        raise RuntimeError(f"MIDI file not found: {midi_path}")
-    
-    # Generate unique output filename
-    out_name = f"track_{uuid.uuid4().hex}.wav"
-    wav_path = OUT_DIR / out_name
-    
-    # Run FluidSynth to render MIDI to WAV
-    # Correct syntax: fluidsynth -ni -F output.wav -r 44100 soundfont.sf2 input.mid
-    cmd = [
-        "fluidsynth",
-        "-ni",                   # Non-interactive mode (required for rendering)
-        "-F", str(wav_path),     # Output WAV file (must come before soundfont)
-        "-r", "44100",           # Sample rate
-        str(SF2_PATH.absolute()),  # SoundFont file (absolute path)
-        str(Path(midi_path).absolute()),  # Input MIDI (absolute path)
-    ]
+    The predictor is inherently sequential within a block, so both directions
+    step through the samples of a block once and process every block of the
+    buffer at the same time as one NumPy vector.
+    """
     
-    print(f"FluidSynth command: {' '.join(cmd)}")
+    name = "ima_adpcm"
+    frame_bytes = IMA_BLOCK_ALIGN
+    frame_samples = IMA_SAMPLES_PER_BLOCK
     
-    try:
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
+    def encode(self, samples: np.ndarray) -> bytes:
+        blocks = samples.astype(np.int32).reshape(-1, IMA_SAMPLES_PER_BLOCK)
+        n = len(blocks)
+        predictor = blocks[:, 0].copy()
+        # Blocks are encoded independently, so each starts from a step size
+        # fitted to its own opening slope instead of the previous block's state
+        slope = np.abs(np.diff(blocks[:, :9], axis=1)).mean(axis=1)
+        index = np.clip(np.searchsorted(IMA_STEP_TABLE, slope), 0, 88).astype(np.int32)
         
-        print(f"FluidSynth stdout: {result.stdout}")
-        if result.stderr:
-            print(f"FluidSynth stderr: {result.stderr}")
-        print(f"FluidSynth return code: {result.returncode}")
+        header = np.zeros((n, 4), dtype=np.uint8)
+        header[:, :2] = predictor.astype("<i2").view(np.uint8).reshape(n, 2)
+        header[:, 2] = index
         
-        # Check if file was created
-        if not wav_path.exists():
-            raise RuntimeError(f"FluidSynth did not create output file. Return code: {result.returncode}, stderr: {result.stderr}")
+        codes = np.empty((n, IMA_SAMPLES_PER_BLOCK - 1), dtype=np.uint8)
+        for j in range(1, IMA_SAMPLES_PER_BLOCK):
+            step = IMA_STEP_TABLE[index]
+            diff = blocks[:, j] - predictor
+            code = np.where(diff < 0, 8, 0)
+            diff = np.abs(diff)
+            delta = step >> 3
+            for bit, part in ((4, step), (2, step >> 1), (1, step >> 2)):
+                hit = diff >= part
+                code |= np.where(hit, bit, 0)
+                diff -= np.where(hit, part, 0)
+                delta += np.where(hit, part, 0)
+            predictor = np.clip(np.where(code & 8, predictor - delta, predictor + delta), -32768, 32767)
+            index = np.clip(index + IMA_INDEX_TABLE[code & 7], 0, 88)
+            codes[:, j - 1] = code
         
-        print(f"FluidSynth rendered: {wav_path} ({wav_path.stat().st_size} bytes)")
-        return str(wav_path)
+        packed = codes[:, 0::2] | (codes[:, 1::2] << 4)
+        return np.concatenate([header, packed], axis=1).tobytes()
+    
+    def decode(self, data: bytes) -> np.ndarray:
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, IMA_BLOCK_ALIGN)
+        predictor = raw[:, :2].copy().view("<i2").reshape(-1).astype(np.int32)
+        index = raw[:, 2].astype(np.int32)
+        codes = np.empty((len(raw), IMA_SAMPLES_PER_BLOCK - 1), dtype=np.int32)
+        codes[:, 0::2] = raw[:, 4:] & 0x0F
+        codes[:, 1::2] = raw[:, 4:] >> 4
         
-    except subprocess.TimeoutExpired:
-        raise RuntimeError("FluidSynth rendering timed out")
+        out = np.empty((len(raw), IMA_SAMPLES_PER_BLOCK), dtype=np.int16)
+        out[:, 0] = predictor
+        for j in range(IMA_SAMPLES_PER_BLOCK - 1):
+            code = codes[:, j]
+            step = IMA_STEP_TABLE[index]
+            delta = (step >> 3) + np.where(code & 4, step, 0) + np.where(code & 2, step >> 1, 0) + np.where(code & 1, step >> 2, 0)
+            predictor = np.clip(np.where(code & 8, predictor - delta, predictor + delta), -32768, 32767)
+            index = np.clip(index + IMA_INDEX_TABLE[code & 7], 0, 88)
+            out[:, j + 1] = predictor
+        return out.reshape(-1)
+    
+    def describe(self) -> dict:
+        info = super().describe()
+        info["block_align"] = IMA_BLOCK_ALIGN
+        return info
 
 
-def wav_to_mp3(wav_path: str) -> str:
-    """
-    Convert WAV to MP3 using FFmpeg.
-    Returns the path to the generated MP3 file.
-    """
-    mp3_path = Path(wav_path).with_suffix(".mp3")
-    
-    try:
-        subprocess.run([
-            "ffmpeg",
-            "-y",                     # Overwrite output
-            "-i", wav_path,           # Input WAV
-            "-codec:a", "libmp3lame", # MP3 codec
-            "-q:a", "3",              # Quality (0-9, lower is better)
-            str(mp3_path)
-        ], check=True, capture_output=True, text=True, timeout=60)
-        
-        print(f"FFmpeg converted to MP3: {mp3_path}")
-        return str(mp3_path)
-        
-    except subprocess.CalledProcessError as e:
-        print(f"FFmpeg error: {e.stderr}")
-        raise RuntimeError(f"FFmpeg conversion failed: {e.stderr}")
+AUDIO_CODECS: Dict[str, AudioCodec] = {codec.name: codec for codec in (AudioCodec(), MuLawCodec(), ImaAdpcmCodec())}
 
+# A streamed render is encoded in batches of at least this much PCM16, on the
+# render executor, so small synth blocks don't each cost an encode on the loop
+STREAM_ENCODE_BYTES = int(os.getenv("STREAM_ENCODE_BYTES", str(64 * 1024)))
 
-def wav_to_pcm16_base64(wav_path: str, target_sample_rate: int = 48000) -> tuple:
+
+class AudioEncoder:
     """
-    Convert WAV to PCM16 mono audio and return as base64.
-    
-    For Spectacles DynamicAudioOutput which requires:
-    - PCM 16-bit signed little-endian
-    - 48000 Hz sample rate
-    - Mono channel
+    Encodes the PCM16 of one transfer as it arrives.
     
-    Returns: (base64_string, sample_count, channels)
+    feed() encodes the whole codec frames available so far and keeps the rest;
+    flush() pads the tail to a full frame (the client stops at sample_count).
+    PCM16 passes through untouched.
     """
-    pcm_path = Path(wav_path).with_suffix(".pcm")
     
-    try:
-        # Convert to PCM16 mono at 48kHz using FFmpeg
-        subprocess.run([
-            "ffmpeg",
-            "-y",                      # Overwrite output
-            "-i", wav_path,            # Input WAV
-            "-ar", str(target_sample_rate),  # Sample rate 48kHz
-            "-ac", "1",                # Mono channel
-            "-f", "s16le",             # PCM 16-bit signed little-endian
-            "-acodec", "pcm_s16le",    # PCM codec
-            str(pcm_path)
-        ], check=True, capture_output=True, text=True, timeout=60)
-        
-        # Read PCM data and convert to base64
-        with open(pcm_path, "rb") as f:
-            pcm_data = f.read()
-        
-        # Calculate sample count (2 bytes per sample for 16-bit)
-        sample_count = len(pcm_data) // 2
-        
-        # Encode as base64
-        pcm_base64 = base64.b64encode(pcm_data).decode('utf-8')
-        
-        # Clean up temp file
-        os.unlink(pcm_path)
-        
-        print(f"PCM16 conversion: {len(pcm_data)} bytes, {sample_count} samples @ {target_sample_rate}Hz")
-        
-        return pcm_base64, sample_count, 1  # 1 = mono
-        
-    except subprocess.CalledProcessError as e:
-        print(f"FFmpeg PCM error: {e.stderr}")
-        raise RuntimeError(f"FFmpeg PCM conversion failed: {e.stderr}")
+    def __init__(self, codec: AudioCodec):
+        self.codec = codec
+        self.pending = b""
+    
+    def feed(self, pcm) -> bytes:
+        if self.codec.name == "pcm16":
+            return pcm
+        data = self.pending + bytes(pcm)
+        usable = len(data) - len(data) % (self.codec.frame_samples * 2)
+        self.pending = data[usable:]
+        if not usable:
+            return b""
+        return self.codec.encode(np.frombuffer(data[:usable], dtype="<i2"))
+    
+    def flush(self) -> bytes:
+        if not self.pending:
+            return b""
+        samples = np.frombuffer(self.pending, dtype="<i2")
+        self.pending = b""
+        padded = np.zeros(-(-len(samples) // self.codec.frame_samples) * self.codec.frame_samples, dtype=np.int16)
+        padded[:len(samples)] = samples
+        return self.codec.encode(padded)
+    
+    def encode_all(self, pcm):
+        """Encode a complete buffer (feed + flush)."""
+        body = self.feed(pcm)
+        tail = self.flush()
+        return body + tail if tail else body
+    
+    def chunk_bytes(self, size: int) -> int:
+        """Round a chunk size down to whole codec frames (at least one)."""
+        frame = self.codec.frame_bytes
+        return max(frame, size - size % frame)
 
 
-def generate_audio_pcm16_from_midi(midi_path: str, sample_rate: int = 48000) -> dict:
-    """
-    Generate PCM16 audio from MIDI for Spectacles DynamicAudioOutput.
+# ============================================================================
+# WEBSOCKET FOR SPECTACLES
+# ============================================================================
+
+# Audio transports a client can choose with the set_transport action. "json" sends
+# base64 audio_chunk messages (the default, and what older lens builds expect);
+# "binary" sends each chunk as one binary frame: BINARY_CHUNK_HEADER + raw PCM16.
+AUDIO_TRANSPORTS = ("json", "binary")
+
+# Binary chunk header: transfer_id, chunk_index (uint32 each, little-endian)
+BINARY_CHUNK_HEADER = struct.Struct("<II")
+
+_transfer_ids = itertools.count(1)
+
+# Credit-based flow control, opted into with the set_flow_control action. The
+# client acks chunks (audio_ack) and the server keeps at most `window` chunks
+# unacknowledged, sizing chunks to the throughput measured from those acks.
+# Clients that never opt in get fixed-size chunks with a 10 ms gap, as before.
+FLOW_DEFAULT_WINDOW = 8
+FLOW_MAX_WINDOW = 64
+FLOW_MIN_CHUNK = 8192
+FLOW_MAX_CHUNK = 131072
+FLOW_TARGET_CHUNK_SECONDS = 0.05  # ~50 ms of link time per chunk
+FLOW_ACK_TIMEOUT = float(os.getenv("FLOW_ACK_TIMEOUT", "10"))
+
+# Finished audio payloads kept per client_id so a client that reconnects can
+# resume a broken transfer (resume action) instead of regenerating it
+RESUME_TTL_SECONDS = float(os.getenv("RESUME_TTL_SECONDS", "120"))
+RESUME_MAX_TRANSFERS = 4
+
+# Content hashes of clips each client_id says it has cached (have_audio); a
+# known clip is announced in audio_start but its chunks are not sent
+KNOWN_AUDIO_PER_CLIENT = 256
+# ...dropped this long after the last connection for that client_id closes
+KNOWN_AUDIO_TTL_SECONDS = float(os.getenv("KNOWN_AUDIO_TTL_SECONDS", "3600"))
+
+# Longest a single send (or a wait for outbox room) may block before a room
+# member counts as stuck and is evicted, so it cannot hold the room back
+SEND_TIMEOUT_SECONDS = float(os.getenv("SEND_TIMEOUT_SECONDS", "5"))
+
+# The same limit for a connection outside any room: generous, so a slow link
+# still gets its audio slowly. A connection that exceeds it is closed.
+SOLO_SEND_TIMEOUT_SECONDS = float(os.getenv("SOLO_SEND_TIMEOUT_SECONDS", "60"))
+
+# Longest a room member's whole copy of a clip may take once its turn comes;
+# a member that is slower (even if still making progress) is evicted
+ROOM_TRANSFER_TIMEOUT_SECONDS = float(os.getenv("ROOM_TRANSFER_TIMEOUT_SECONDS", "60"))
+
+# Per-connection outbound queues, drained by one writer task per connection.
+# Control messages (pong, status, errors, ...) always go before queued audio,
+# so a ping is never stuck behind a long transfer. The audio queue is small:
+# a producer that finds it full waits, which paces the transfer to the link.
+OUTBOX_CONTROL_SIZE = 256
+OUTBOX_AUDIO_SIZE = int(os.getenv("OUTBOX_AUDIO_SIZE", "8"))
+AUDIO_MESSAGE_TYPES = ("audio_start", "audio_chunk", "audio_end")
+
+# Outbound JSON encoder: "orjson" (if installed), "json", or "auto" for the best available
+JSON_SERIALIZER = os.getenv("JSON_SERIALIZER", "auto")
+
+# Incoming frames may hold several JSON messages, or part of one; an unfinished
+# message is kept until the next frame, but never more than this many characters
+MAX_PENDING_JSON_CHARS = int(os.getenv("MAX_PENDING_JSON_CHARS", str(1024 * 1024)))
+
+
+class Outbox:
+    """Bounded two-priority outbound queue for one WebSocket, with its writer task."""
     
-    Returns dict with:
-    - audio_base64: base64-encoded PCM16 data
-    - sample_rate: 48000
-    - channels: 1 (mono)
-    - sample_count: number of samples
-    """
-    # First render to WAV at target sample rate
-    wav_path = render_midi_to_wav_48k(midi_path, sample_rate)
+    def __init__(self, websocket: WebSocket, on_error=None, timeout=lambda: SEND_TIMEOUT_SECONDS):
+        self.websocket = websocket
+        self.on_error = on_error
+        self.timeout = timeout  # seconds a send or a put may block; read on every call
+        self.control: asyncio.Queue = asyncio.Queue(maxsize=OUTBOX_CONTROL_SIZE)
+        self.audio: asyncio.Queue = asyncio.Queue(maxsize=OUTBOX_AUDIO_SIZE)
+        self.ready = asyncio.Event()
+        self.error: Optional[BaseException] = None
+        self.sent = 0
+        self.high_water = 0
+        self.closed = False
+        self.writer = asyncio.create_task(self._write())
     
-    # Convert to PCM16 base64
-    pcm_base64, sample_count, channels = wav_to_pcm16_base64(wav_path, sample_rate)
+    async def put(self, kind: str, payload, audio: bool):
+        """Queue a frame ("text" or "bytes"); waits up to timeout() for room."""
+        if self.error is not None:
+            raise ConnectionError(f"WebSocket writer failed: {self.error!r}")
+        queue = self.audio if audio else self.control
+        await asyncio.wait_for(queue.put((kind, payload)), self.timeout())
+        self.high_water = max(self.high_water, self.control.qsize() + self.audio.qsize())
+        self.ready.set()
     
-    # Clean up WAV
-    try:
-        os.unlink(wav_path)
-    except:
-        pass
+    async def _write(self):
+        try:
+            while not self.closed:
+                if not self.control.empty():
+                    kind, payload = self.control.get_nowait()
+                elif not self.audio.empty():
+                    kind, payload = self.audio.get_nowait()
+                else:
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                if kind == "text":
+                    await asyncio.wait_for(self.websocket.send_text(payload), self.timeout())
+                else:
+                    await asyncio.wait_for(self.websocket.send_bytes(payload), self.timeout())
+                self.sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"WebSocket writer stopped: {e!r}")
+            self.error = e
+            # Free producers blocked on a full queue; their next put raises
+            for queue in (self.control, self.audio):
+                while not queue.empty():
+                    queue.get_nowait()
+            if self.on_error is not None:
+                self.on_error(self.websocket, e)
     
-    return {
-        "audio_base64": pcm_base64,
-        "sample_rate": sample_rate,
-        "channels": channels,
-        "sample_count": sample_count
-    }
+    def close(self):
+        # The flag also stops the loop should wait_for swallow the cancellation
+        self.closed = True
+        self.ready.set()
+        self.writer.cancel()
+    
+    def stats(self) -> dict:
+        return {
+            "control_depth": self.control.qsize(),
+            "audio_depth": self.audio.qsize(),
+            "high_water": self.high_water,
+            "sent": self.sent,
+            "failed": self.error is not None,
+        }
 
 
-async def send_audio_chunked(websocket, manager, pcm_data: dict, params: dict, chunk_size: int = 32768):
+class JsonSerializer:
     """
-    Send PCM16 audio in chunks to avoid WebSocket message size limits on Spectacles.
+    Turns outbound messages into WebSocket text frames (stdlib json).
     
-    Args:
-        websocket: WebSocket connection
-        manager: ConnectionManager
-        pcm_data: dict with audio_base64, sample_rate, channels, sample_count
-        params: dict with generation parameters
-        chunk_size: size of each chunk in bytes (before base64, ~32KB is safe)
+    audio_chunk() is the per-chunk hot path: everything but the two numbers and
+    the base64 payload is prebuilt, so no dict is built or walked per chunk.
     """
-    audio_base64 = pcm_data["audio_base64"]
     
-    # Decode base64 to get raw bytes
-    audio_bytes = base64.b64decode(audio_base64)
-    total_bytes = len(audio_bytes)
+    name = "json"
+    _chunk_template = '{"type":"audio_chunk","chunk_index":%d,"total_chunks":%d,"data":"%s"}'
     
-    # Calculate number of chunks
-    num_chunks = (total_bytes + chunk_size - 1) // chunk_size
-    
-    print(f"Sending audio in {num_chunks} chunks ({total_bytes} bytes total)")
+    def __init__(self):
+        # Same output as Starlette's send_json, without its per-call setup
+        self._encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
     
-    # Send audio_start message with metadata
-    await manager.send_json(websocket, {
-        "type": "audio_start",
-        "format": "pcm16",
-        "sample_rate": pcm_data["sample_rate"],
-        "channels": pcm_data["channels"],
-        "sample_count": pcm_data["sample_count"],
-        "total_bytes": total_bytes,
-        "num_chunks": num_chunks,
-        "params": params
-    })
+    def dumps(self, data: dict) -> str:
+        return self._encode(data)
     
-    # Send chunks
-    for i in range(num_chunks):
-        start = i * chunk_size
-        end = min(start + chunk_size, total_bytes)
-        chunk_bytes = audio_bytes[start:end]
-        chunk_base64 = base64.b64encode(chunk_bytes).decode('ascii')
-        
-        await manager.send_json(websocket, {
-            "type": "audio_chunk",
-            "chunk_index": i,
-            "total_chunks": num_chunks,
-            "data": chunk_base64
-        })
-        
-        # Small delay to prevent overwhelming the connection
-        await asyncio.sleep(0.01)
+    def audio_chunk(self, chunk_index: int, total_chunks: int, chunk_bytes) -> str:
+        return self._chunk_template % (chunk_index, total_chunks, base64.b64encode(chunk_bytes).decode("ascii"))
+
+
+class OrjsonSerializer(JsonSerializer):
+    """JsonSerializer with orjson doing the encoding; numpy values are serialized too."""
     
-    # Send audio_end message
-    await manager.send_json(websocket, {
-        "type": "audio_end",
-        "total_chunks": num_chunks,
-        "total_bytes": total_bytes
-    })
+    name = "orjson"
     
-    print(f"Finished sending {num_chunks} audio chunks")
+    def dumps(self, data: dict) -> str:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY).decode("utf-8")
+
+
+def make_serializer(name: str = JSON_SERIALIZER) -> JsonSerializer:
+    """Serializer by name; "auto" picks orjson when it is installed."""
+    if name == "auto":
+        name = "orjson" if orjson is not None else "json"
+    if name == "orjson":
+        if orjson is None:
+            raise ValueError("JSON_SERIALIZER=orjson but orjson is not installed")
+        return OrjsonSerializer()
+    if name == "json":
+        return JsonSerializer()
+    raise ValueError(f"Unknown JSON serializer: {name}")
 
 
-def render_midi_to_wav_48k(midi_path: str, sample_rate: int = 48000) -> str:
+class JsonMessageDecoder:
     """
-    Render MIDI to WAV at 48kHz for Spectacles compatibility.
+    Incremental decoder for the JSON messages of one WebSocket.
+    
+    feed() takes a text or binary frame and returns every complete object in
+    it, in order; json.JSONDecoder.raw_decode does the parsing, so a frame is
+    scanned once in C. A trailing unfinished object (or UTF-8 sequence) is kept
+    and completed by the next frame. Whitespace and NUL padding between
+    messages are skipped.
     """
-    if not SF2_PATH.exists():
-        raise RuntimeError(f"SoundFont not found: {SF2_PATH}")
     
-    if not Path(midi_path).exists():
-        raise RuntimeError(f"MIDI file not found: {midi_path}")
+    _decoder = json.JSONDecoder()
+    _literals = ("true", "false", "null", "NaN", "Infinity", "-Infinity")
+    _partial_number = re.compile(r"[.eE][+-]?")
+    # A \uXXXX escape at the end of the text, or a high surrogate with all or
+    # part of its low surrogate (they only decode together)
+    _partial_escape = re.compile(r"u[0-9a-fA-F]{0,4}|u[dD][89abAB][0-9a-fA-F]{2}\\(u[0-9a-fA-F]{0,4})?")
     
-    out_name = f"track_{uuid.uuid4().hex}_48k.wav"
-    wav_path = OUT_DIR / out_name
+    def __init__(self):
+        self.pending = ""
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
     
-    cmd = [
-        "fluidsynth",
-        "-ni",
-        "-F", str(wav_path),
-        "-r", str(sample_rate),  # 48kHz for Spectacles
-        str(SF2_PATH.absolute()),
-        str(Path(midi_path).absolute()),
-    ]
+    def feed(self, frame) -> tuple:
+        """Decode a frame; returns (messages, error) where error is a JSONDecodeError or None."""
+        if isinstance(frame, (bytes, bytearray, memoryview)):
+            frame = self.utf8.decode(frame)
+        text = self.pending + frame
+        self.pending = ""
+        messages = []
+        pos = 0
+        end = len(text)
+        while True:
+            while pos < end and text[pos] in " \t\r\n\x00":
+                pos += 1
+            if pos == end:
+                return messages, None
+            start = pos
+            try:
+                obj, pos = self._decoder.raw_decode(text, pos)
+            except json.JSONDecodeError as e:
+                if not self._truncated(text, e):
+                    return messages, e
+                if end - pos > MAX_PENDING_JSON_CHARS:
+                    return messages, json.JSONDecodeError(
+                        f"Message longer than {MAX_PENDING_JSON_CHARS} characters", text, pos
+                    )
+                self.pending = text[pos:]
+                return messages, None
+            if not isinstance(obj, dict):
+                return messages, json.JSONDecodeError("Expected a JSON object", text, start)
+            messages.append(obj)
     
-    print(f"FluidSynth (48kHz) command: {' '.join(cmd)}")
+    @classmethod
+    def _truncated(cls, text: str, error: json.JSONDecodeError) -> bool:
+        """Whether the error only means the text stops before the object is complete."""
+        if error.msg.startswith("Unterminated string"):
+            return True
+        if error.pos >= len(text):
+            return True
+        tail = text[error.pos:]
+        if error.msg == "Expecting value":
+            return any(word.startswith(tail) for word in cls._literals)
+        if error.msg.startswith("Invalid \\uXXXX escape"):
+            # Frame ends in or right after an escape (error.pos is at the "u")
+            return cls._partial_escape.fullmatch(tail) is not None
+        # A number cut after its "." or exponent
+        return cls._partial_number.fullmatch(tail) is not None
+
+
+def audio_content_hash(pcm) -> str:
+    """Hash of the decoded PCM16 of a clip; identical audio hashes alike whatever the codec."""
+    return hashlib.blake2b(pcm, digest_size=16).hexdigest()
+
+
+def next_transfer_id() -> int:
+    """Id tying an audio_start/audio_end pair to its chunks (wraps at 2**32)."""
+    return next(_transfer_ids) & 0xFFFFFFFF
+
+
+class ChunkPacer:
+    """Paces one audio transfer for a client without flow control: fixed chunks, 10 ms apart."""
     
-    try:
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
-        
-        if not wav_path.exists():
-            raise RuntimeError(f"FluidSynth did not create output file")
-        
-        print(f"FluidSynth rendered @ 48kHz: {wav_path} ({wav_path.stat().st_size} bytes)")
-        return str(wav_path)
-        
-    except subprocess.TimeoutExpired:
-        raise RuntimeError("FluidSynth rendering timed out")
+    def __init__(self, websocket: WebSocket, transfer_id: int, chunk_size: int):
+        self.websocket = websocket
+        self.transfer_id = transfer_id
+        self.chunk_size = chunk_size
+        self.chunks = 0
+        self.bytes = 0
+        self.stalls = 0
+        self.skipped = False
+        self.started = time.monotonic()
+    
+    def skip(self):
+        """Stop sending chunks: the client already has this clip."""
+        self.skipped = True
+    
+    async def wait_for_credit(self):
+        pass
+    
+    async def sent(self, nbytes: int):
+        self.chunks += 1
+        self.bytes += nbytes
+        await asyncio.sleep(0.01)
+    
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            "transfer_id": self.transfer_id,
+            "flow_control": False,
+            "chunks": self.chunks,
+            "bytes": self.bytes,
+            "skipped": self.skipped,
+            "seconds": round(elapsed, 3),
+            "throughput_kbps": round(self.bytes * 8 / 1000 / elapsed, 1) if elapsed > 0 else None,
+        }
 
 
-def generate_audio_from_midi(midi_path: str, format: str = "wav") -> tuple:
+class TransferFlow(ChunkPacer):
     """
-    Generate audio file from MIDI and return (file_path, url).
-    For Spectacles, use format="mp3" for better compatibility.
+    Credit window for one audio transfer.
+    
+    At most `window` chunks may be unacknowledged; the sender waits for an
+    audio_ack before sending more. Every ack that advances the window updates a
+    smoothed delivery-rate estimate, and the next chunks are sized to carry
+    about FLOW_TARGET_CHUNK_SECONDS of it.
     """
-    wav_path = render_midi_to_wav(midi_path)
     
-    if format == "mp3":
-        audio_path = wav_to_mp3(wav_path)
-        # Clean up WAV file after MP3 conversion to save space
-        try:
-            os.unlink(wav_path)
-        except:
-            pass  # Ignore if already deleted
-    else:
-        audio_path = wav_path
+    def __init__(self, websocket: WebSocket, transfer_id: int, chunk_size: int, window: int):
+        super().__init__(websocket, transfer_id, chunk_size)
+        self.window = window
+        self.acked = 0           # chunks acknowledged (cumulative)
+        self.acked_bytes = 0
+        self.chunk_sizes: List[int] = []
+        self.send_times: List[float] = []
+        self.rtts: List[float] = []
+        self.rate: Optional[float] = None  # bytes/s
+        self.last_ack: Optional[float] = None
+        self.changed = asyncio.Event()
     
-    # Build URL for Lens Studio to fetch
-    filename = Path(audio_path).name
-    url = f"{HOST_URL}/out/{filename}"
+    async def wait_for_credit(self):
+        if self.chunks - self.acked < self.window:
+            return
+        self.stalls += 1
+        while self.chunks - self.acked >= self.window and not self.skipped:
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), FLOW_ACK_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise RuntimeError(
+                    f"No audio_ack for transfer {self.transfer_id} within {FLOW_ACK_TIMEOUT:g}s"
+                )
     
-    return audio_path, url
-
-
-def generate_midi_bytes(req: GenerateRequest) -> bytes:
-    """Generate melody MIDI and return as bytes."""
-    path = generate_melody_midi(req)
-    with open(path, "rb") as f:
-        data = f.read()
-    os.unlink(path)
-    return data
-
-
-def generate_drums_bytes(req: DrumifyRequest) -> bytes:
-    """Generate drums MIDI and return as bytes."""
-    path = generate_drums_midi(req)
-    with open(path, "rb") as f:
-        data = f.read()
-    os.unlink(path)
-    return data
+    def skip(self):
+        super().skip()
+        self.changed.set()
+    
+    async def sent(self, nbytes: int):
+        now = time.monotonic()
+        if self.last_ack is None:
+            self.last_ack = now
+        self.chunk_sizes.append(nbytes)
+        self.send_times.append(now)
+        self.chunks += 1
+        self.bytes += nbytes
+    
+    def ack(self, chunk_index: int, window: Optional[int] = None):
+        """Record that every chunk up to and including chunk_index has arrived."""
+        if window:
+            self.window = max(1, min(FLOW_MAX_WINDOW, int(window)))
+        through = min(chunk_index + 1, self.chunks)
+        if through > self.acked:
+            now = time.monotonic()
+            newly_acked = sum(self.chunk_sizes[self.acked:through])
+            self.rtts.append(now - self.send_times[through - 1])
+            if now > self.last_ack:
+                sample = newly_acked / (now - self.last_ack)
+                self.rate = sample if self.rate is None else 0.7 * self.rate + 0.3 * sample
+                size = int(self.rate * FLOW_TARGET_CHUNK_SECONDS) & ~1  # whole samples
+                self.chunk_size = max(FLOW_MIN_CHUNK, min(FLOW_MAX_CHUNK, size))
+            self.acked = through
+            self.acked_bytes += newly_acked
+            self.last_ack = now
+        self.changed.set()
+    
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats.update({
+            "flow_control": True,
+            "window": self.window,
+            "acked_chunks": self.acked,
+            "stalls": self.stalls,
+            "rtt_ms": round(1000 * sum(self.rtts) / len(self.rtts), 1) if self.rtts else None,
+            "link_kbps": round(self.rate * 8 / 1000, 1) if self.rate else None,
+            "chunk_bytes": [min(self.chunk_sizes), max(self.chunk_sizes)] if self.chunk_sizes else None,
+        })
+        return stats
 
 
-@app.websocket("/ws/spectacles/{client_id}")
-async def websocket_spectacles(websocket: WebSocket, client_id: str):
-    """
-    WebSocket endpoint for Snap Spectacles.
+class ConnectionManager:
+    """Manages WebSocket connections for Spectacles clients."""
     
-    Message Protocol:
+    def __init__(self):
+        self.active_connections: List[WebSocket] = []
+        self.client_states: Dict[str, Dict[str, Any]] = {}
+        self.transports: Dict[WebSocket, str] = {}
+        self.codecs: Dict[WebSocket, str] = {}
+        self.flow_windows: Dict[WebSocket, int] = {}
+        self.transfers: Dict[int, ChunkPacer] = {}
+        self.recent_transfers: deque = deque(maxlen=32)
+        self.jobs: Dict[WebSocket, set] = {}
+        self.job_locks: Dict[WebSocket, asyncio.Lock] = {}
+        self.client_ids: Dict[WebSocket, str] = {}
+        # client_id -> transfer_id -> resumable transfer; survives disconnects
+        self.resume_buffers: Dict[str, "OrderedDict[int, dict]"] = {}
+        # client_id -> content hashes the client has cached; survives disconnects
+        self.known_audio: Dict[str, "OrderedDict[str, None]"] = {}
+        # client_id -> when its known_audio expires, while it has no connection
+        self.known_audio_expires: Dict[str, float] = {}
+        # Rooms: headsets that hear the same renders
+        self.rooms: Dict[str, set] = {}
+        self.member_rooms: Dict[WebSocket, str] = {}
+        self.outboxes: Dict[WebSocket, Outbox] = {}
+        self.serializer = make_serializer()
     
-    Client → Server:
-    {
-        "action": "generate_melody" | "generate_drums" | "update_params" | "ping",
-        "params": { ... }
-    }
+    async def connect(self, websocket: WebSocket, client_id: str):
+        await websocket.accept()
+        self.active_connections.append(websocket)
+        self.client_ids[websocket] = client_id
+        self.known_audio_expires.pop(client_id, None)
+        self._expire_known_audio()
+        self.outboxes[websocket] = Outbox(
+            websocket, on_error=self._writer_failed, timeout=lambda: self.send_timeout(websocket)
+        )
+        self.client_states[client_id] = {
+            "connected_at": datetime.now().isoformat(),
+            "tempo_bpm": 120,
+            "scale": "C_major",
+            "density": 0.55,
+            "variation": 0.35,
+            "drum_style": "techno",
+            "swing": 0.0
+        }
+        print(f"🕶️ Spectacles client connected: {client_id}")
     
-    Server → Client:
-    {
-        "type": "midi_data" | "status" | "error" | "pong",
-        "data": { ... }
-    }
-    """
-    await manager.connect(websocket, client_id)
+    def disconnect(self, websocket: WebSocket, client_id: str):
+        if websocket not in self.client_ids:
+            return  # Already dropped (e.g. closed after its writer failed)
+        if websocket in self.active_connections:
+            self.active_connections.remove(websocket)
+        if client_id in self.client_states:
+            del self.client_states[client_id]
+        self.leave_room(websocket)
+        outbox = self.outboxes.pop(websocket, None)
+        if outbox is not None:
+            outbox.close()
+        self.client_ids.pop(websocket, None)
+        if client_id not in self.client_ids.values():
+            self.known_audio_expires[client_id] = time.monotonic() + KNOWN_AUDIO_TTL_SECONDS
+        self.transports.pop(websocket, None)
+        self.codecs.pop(websocket, None)
+        self.flow_windows.pop(websocket, None)
+        self.job_locks.pop(websocket, None)
+        for task in self.jobs.pop(websocket, ()):
+            task.cancel()
+        print(f"🕶️ Spectacles client disconnected: {client_id}")
     
-    # Send welcome message with current state
+    def send_timeout(self, websocket: WebSocket) -> float:
+        """Send timeout for a connection: tight in a room, generous on its own."""
+        return SEND_TIMEOUT_SECONDS if websocket in self.member_rooms else SOLO_SEND_TIMEOUT_SECONDS
+    
+    def _writer_failed(self, websocket: WebSocket, error: BaseException):
+        # Queued sends return before the write fails, so the connection is dropped here
+        asyncio.create_task(self.drop_connection(websocket, str(error) or type(error).__name__))
+    
+    async def drop_connection(self, websocket: WebSocket, reason: str):
+        """Evict a connection whose writer failed from its room, close it (1011) and forget it."""
+        client_id = self.client_ids.get(websocket)
+        if client_id is None:
+            return
+        if websocket in self.member_rooms:
+            await self.evict_from_room(websocket, reason)
+        try:
+            await asyncio.wait_for(websocket.close(code=1011, reason=f"Send failed: {reason}"[:120]), SEND_TIMEOUT_SECONDS)
+        except Exception:
+            pass  # The transport may be gone already
+        self.disconnect(websocket, client_id)
+    
+    def set_serializer(self, serializer: JsonSerializer):
+        """Swap the encoder used for every outbound JSON message."""
+        self.serializer = serializer
+    
+    async def send_json(self, websocket: WebSocket, data: dict):
+        """Serialize a message and queue it (audio messages behind control ones)."""
+        await self.send_text(websocket, self.serializer.dumps(data), audio=data.get("type") in AUDIO_MESSAGE_TYPES)
+    
+    async def send_text(self, websocket: WebSocket, text: str, audio: bool = False):
+        """Queue an already serialized JSON message on the connection's outbox."""
+        outbox = self.outboxes.get(websocket)
+        try:
+            if outbox is None:
+                await asyncio.wait_for(websocket.send_text(text), SEND_TIMEOUT_SECONDS)
+            else:
+                await outbox.put("text", text, audio=audio)
+        except Exception as e:
+            print(f"Error sending JSON to client: {e!r}")
+            raise  # Re-raise to let caller handle
+    
+    async def send_bytes(self, websocket: WebSocket, data: bytes):
+        """Queue a binary frame (always audio) on the connection's outbox."""
+        outbox = self.outboxes.get(websocket)
+        try:
+            if outbox is None:
+                await asyncio.wait_for(websocket.send_bytes(data), SEND_TIMEOUT_SECONDS)
+            else:
+                await outbox.put("bytes", data, audio=True)
+        except Exception as e:
+            print(f"Error sending bytes to client: {e}")
+            raise  # Re-raise to let caller handle
+    
+    def transport(self, websocket: WebSocket) -> str:
+        """Audio transport negotiated by this connection ("json" unless it asked otherwise)."""
+        return self.transports.get(websocket, "json")
+    
+    def set_transport(self, websocket: WebSocket, transport: str):
+        if transport not in AUDIO_TRANSPORTS:
+            raise ValueError(f"Unknown transport: {transport}. Available: {list(AUDIO_TRANSPORTS)}")
+        self.transports[websocket] = transport
+    
+    def codec(self, websocket: WebSocket) -> AudioCodec:
+        """Audio codec negotiated by this connection (PCM16 unless it asked otherwise)."""
+        return AUDIO_CODECS[self.codecs.get(websocket, "pcm16")]
+    
+    def set_codec(self, websocket: WebSocket, codec: str):
+        if codec not in AUDIO_CODECS:
+            raise ValueError(f"Unknown codec: {codec}. Available: {list(AUDIO_CODECS)}")
+        self.codecs[websocket] = codec
+    
+    def set_flow_control(self, websocket: WebSocket, window: int):
+        """Enable credit-based flow control with `window` chunks in flight (0 disables it)."""
+        if window:
+            self.flow_windows[websocket] = max(1, min(FLOW_MAX_WINDOW, int(window)))
+        else:
+            self.flow_windows.pop(websocket, None)
+    
+    def open_transfer(self, websocket: WebSocket, chunk_size: int, transfer_id: Optional[int] = None) -> ChunkPacer:
+        """Start (or resume) an audio transfer and return the pacer its chunks go through."""
+        if transfer_id is None:
+            transfer_id = next_transfer_id()
+        window = self.flow_windows.get(websocket)
+        if window:
+            pacer = TransferFlow(websocket, transfer_id, chunk_size, window)
+        else:
+            pacer = ChunkPacer(websocket, transfer_id, chunk_size)
+        self.transfers[transfer_id] = pacer
+        return pacer
+    
+    def close_transfer(self, pacer: ChunkPacer) -> dict:
+        self.transfers.pop(pacer.transfer_id, None)
+        stats = pacer.stats()
+        self.recent_transfers.append(stats)
+        return stats
+    
+    def ack(self, websocket: WebSocket, transfer_id: int, chunk_index: int, window: Optional[int] = None) -> bool:
+        pacer = self.transfers.get(transfer_id)
+        if not isinstance(pacer, TransferFlow) or pacer.websocket is not websocket:
+            return False
+        pacer.ack(chunk_index, window)
+        return True
+    
+    def remember_transfer(self, websocket: WebSocket, transfer_id: int, payload, start: dict, bounds: List[tuple]):
+        """
+        Keep a transfer's complete encoded payload for RESUME_TTL_SECONDS.
+        
+        `start` is its audio_start message and `bounds` the (start, end) byte
+        range of every chunk sent so far; the sender keeps appending to it.
+        """
+        client_id = self.client_ids.get(websocket)
+        if client_id is None:
+            return
+        self._expire_transfers()
+        buffer = self.resume_buffers.setdefault(client_id, OrderedDict())
+        buffer[transfer_id] = {
+            "payload": payload,
+            "start": start,
+            "bounds": bounds,
+            "expires": time.monotonic() + RESUME_TTL_SECONDS,
+        }
+        while len(buffer) > RESUME_MAX_TRANSFERS:
+            buffer.popitem(last=False)
+    
+    def find_transfer(self, client_id: str, transfer_id: int) -> Optional[dict]:
+        self._expire_transfers()
+        return self.resume_buffers.get(client_id, {}).get(transfer_id)
+    
+    def _expire_transfers(self):
+        now = time.monotonic()
+        for client_id in list(self.resume_buffers):
+            buffer = self.resume_buffers[client_id]
+            for transfer_id in [t for t, entry in buffer.items() if entry["expires"] <= now]:
+                del buffer[transfer_id]
+            if not buffer:
+                del self.resume_buffers[client_id]
+    
+    def add_known_audio(self, client_id: str, hashes: List[str]):
+        known = self.known_audio.setdefault(client_id, OrderedDict())
+        for content_hash in hashes:
+            known[content_hash] = None
+            known.move_to_end(content_hash)
+        while len(known) > KNOWN_AUDIO_PER_CLIENT:
+            known.popitem(last=False)
+    
+    def _expire_known_audio(self):
+        now = time.monotonic()
+        for client_id in [c for c, expires in self.known_audio_expires.items() if expires <= now]:
+            del self.known_audio_expires[client_id]
+            self.known_audio.pop(client_id, None)
+    
+    def forget_known_audio(self, client_id: str, hashes: List[str]):
+        known = self.known_audio.get(client_id, {})
+        for content_hash in hashes:
+            known.pop(content_hash, None)
+    
+    def client_has_audio(self, websocket: WebSocket, content_hash: str) -> bool:
+        return content_hash in self.known_audio.get(self.client_ids.get(websocket), {})
+    
+    def skip_transfer(self, websocket: WebSocket, transfer_id: int) -> bool:
+        """Stop a running transfer whose clip the client turned out to have."""
+        pacer = self.transfers.get(transfer_id)
+        if pacer is None or pacer.websocket is not websocket:
+            return False
+        pacer.skip()
+        return True
+    
+    def start_job(self, websocket: WebSocket, job):
+        """
+        Run a coroutine in the background for this connection.
+        
+        Jobs of one connection run one at a time, in the order they were started,
+        so their audio transfers never interleave; the receive loop stays free to
+        handle acks meanwhile. Pending jobs are cancelled on disconnect.
+        """
+        lock = self.job_locks.setdefault(websocket, asyncio.Lock())
+        
+        async def run():
+            try:
+                async with lock:
+                    await job
+            except Exception as e:
+                # The job could not even report its error (connection gone)
+                print(f"Background job failed: {e}")
+            finally:
+                job.close()  # no-op once awaited; avoids a warning if cancelled while queued
+        
+        task = asyncio.create_task(run())
+        tasks = self.jobs.setdefault(websocket, set())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return task
+    
+    async def broadcast(self, message: dict, connections: Optional[List[WebSocket]] = None) -> List[WebSocket]:
+        """
+        Send a message to many connections concurrently (default: all of them).
+        
+        Each send has its own timeout, so one slow connection does not hold the
+        others back. Returns the connections the message could not be sent to.
+        """
+        targets = list(self.active_connections if connections is None else connections)
+        results = await asyncio.gather(*(self.send_json(ws, message) for ws in targets), return_exceptions=True)
+        return [ws for ws, result in zip(targets, results) if isinstance(result, Exception)]
+    
+    def join_room(self, websocket: WebSocket, room: str):
+        self.leave_room(websocket)
+        self.rooms.setdefault(room, set()).add(websocket)
+        self.member_rooms[websocket] = room
+    
+    def leave_room(self, websocket: WebSocket) -> Optional[str]:
+        room = self.member_rooms.pop(websocket, None)
+        if room is not None:
+            members = self.rooms.get(room, set())
+            members.discard(websocket)
+            if not members:
+                self.rooms.pop(room, None)
+        return room
+    
+    def room_peers(self, websocket: WebSocket) -> List[WebSocket]:
+        """The other members of this connection's room (empty when not in one)."""
+        room = self.member_rooms.get(websocket)
+        return [ws for ws in self.rooms.get(room, ()) if ws is not websocket]
+    
+    async def announce_room(self, room: str):
+        """Tell every member who is in the room."""
+        members = list(self.rooms.get(room, ()))
+        await self.broadcast({
+            "type": "room_update",
+            "room": room,
+            "members": [self.client_ids.get(ws) for ws in members]
+        }, members)
+    
+    async def evict_from_room(self, websocket: WebSocket, reason: str):
+        """Drop a member that cannot keep up so the rest of the room is not held back."""
+        room = self.leave_room(websocket)
+        if room is None:
+            return
+        print(f"Evicted {self.client_ids.get(websocket)} from room {room}: {reason}")
+        await self.broadcast({"type": "room_evicted", "room": room, "reason": reason}, [websocket])
+        await self.announce_room(room)
+
+
+manager = ConnectionManager()
+
+
+# ============================================================================
+# FLUIDSYNTH WORKER POOL (SoundFont loaded once per worker)
+# ============================================================================
+
+# Number of long-lived synthesizers per sample rate. Each one keeps the SoundFont
+# loaded, so a render job only pays for synthesis, not for parsing the SF2.
+FLUIDSYNTH_POOL_SIZE = int(os.getenv("FLUIDSYNTH_POOL_SIZE", "2"))
+
+# Frames rendered per get_samples() call
+SYNTH_BLOCK_FRAMES = 4096
+
+_synth_pools: Dict[int, Optional["SynthPool"]] = {}
+_synth_pools_lock = threading.Lock()
+
+
+class SynthPool:
+    """
+    Pool of in-process FluidSynth synthesizers with the SoundFont preloaded.
+
+    Render jobs borrow a synth, play the MIDI events into it block by block
+    and hand it back after a system reset.
+    """
+
+    def __init__(self, sf2_path: Path, sample_rate: int, size: int):
+        self.sf2_path = sf2_path
+        self.sample_rate = sample_rate
+        self.size = size
+        self._idle: "queue.Queue" = queue.Queue()
+        for _ in range(size):
+            self._idle.put(self._create_synth())
+        print(f"🎹 FluidSynth pool ready: {size} worker(s) @ {sample_rate}Hz ({sf2_path.name})")
+
+    def _create_synth(self):
+        synth = fluidsynth.Synth(gain=0.2, samplerate=float(self.sample_rate))
+        # update_midi_preset=1 assigns default presets like the CLI does (drums on channel 10)
+        sfid = synth.sfload(str(self.sf2_path.absolute()), update_midi_preset=1)
+        if sfid < 0:
+            synth.delete()
+            raise RuntimeError(f"FluidSynth could not load SoundFont: {self.sf2_path}")
+        return synth
+
+    @contextmanager
+    def acquire(self):
+        """Borrow a synth for the duration of one render job."""
+        synth = self._idle.get()
+        try:
+            yield synth
+        finally:
+            synth.system_reset()
+            self._idle.put(synth)
+
+    def render_frames(self, midi: MidiFile):
+        """
+        Render a parsed MIDI file and yield interleaved stereo int16 blocks.
+
+        Rendering stops at the last MIDI event, like `fluidsynth -F`.
+        """
+        with self.acquire() as synth:
+            rendered = 0
+            elapsed = 0.0
+            for msg in midi:  # Merged tracks, msg.time in seconds
+                elapsed += msg.time
+                target = int(round(elapsed * self.sample_rate))
+                while rendered < target:
+                    frames = min(SYNTH_BLOCK_FRAMES, target - rendered)
+                    yield synth.get_samples(frames)
+                    rendered += frames
+
+                if msg.type == "note_on":
+                    synth.noteon(msg.channel, msg.note, msg.velocity)
+                elif msg.type == "note_off":
+                    synth.noteoff(msg.channel, msg.note)
+                elif msg.type == "control_change":
+                    synth.cc(msg.channel, msg.control, msg.value)
+                elif msg.type == "program_change":
+                    synth.program_change(msg.channel, msg.program)
+                elif msg.type == "pitchwheel":
+                    synth.pitch_bend(msg.channel, msg.pitch)
+
+
+def get_synth_pool(sample_rate: int = 48000) -> Optional[SynthPool]:
+    """
+    Return the worker pool for a sample rate, creating it on first use.
+
+    Returns None when the pyfluidsynth binding or the SoundFont is unavailable,
+    in which case callers fall back to the fluidsynth CLI.
+    """
+    if fluidsynth is None or FLUIDSYNTH_POOL_SIZE <= 0 or not SF2_PATH.exists():
+        return None
+
+    with _synth_pools_lock:
+        if sample_rate not in _synth_pools:
+            try:
+                _synth_pools[sample_rate] = SynthPool(SF2_PATH, sample_rate, FLUIDSYNTH_POOL_SIZE)
+            except Exception as e:
+                print(f"FluidSynth pool unavailable @ {sample_rate}Hz, using CLI rendering: {e}")
+                _synth_pools[sample_rate] = None
+        return _synth_pools[sample_rate]
+
+
+@app.on_event("startup")
+async def preload_synth_pool():
+    """Load the SoundFont into the 48kHz worker pool and build the drum bank before the first request."""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, get_synth_pool, 48000)
+    await loop.run_in_executor(None, get_drum_bank, 48000)
+
+
+# ============================================================================
+# RENDER CACHE (content-addressed PCM, memory LRU + disk quota)
+# ============================================================================
+
+RENDER_CACHE_DIR = BASE_DIR / "cache" / "pcm"
+RENDER_CACHE_MEMORY_BYTES = int(os.getenv("RENDER_CACHE_MEMORY_MB", "64")) * 1024 * 1024
+RENDER_CACHE_DISK_BYTES = int(os.getenv("RENDER_CACHE_DISK_MB", "512")) * 1024 * 1024
+
+# Bump when the render output changes for the same inputs
+RENDER_CACHE_VERSION = 1
+
+
+class RenderCache:
+    """
+    Cache of rendered PCM keyed by a hash of everything that determines it.
+    
+    Entries live in an in-memory LRU tier bounded by bytes and in an on-disk
+    tier with its own byte budget. Disk hits are promoted back into memory and
+    the oldest files are evicted first (mtime is refreshed on every hit).
+    """
+    
+    def __init__(self, memory_bytes: int, disk_dir: Optional[Path], disk_bytes: int):
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_used = 0
+        self._disk_used = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        if self.disk_dir is not None and self.disk_bytes > 0:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            self._disk_used = sum(p.stat().st_size for p in self.disk_dir.glob("*.pcm"))
+    
+    @staticmethod
+    def make_key(midi_data: bytes, sample_rate: int, **settings) -> str:
+        """Hash MIDI bytes, SoundFont identity, sample rate and render settings."""
+        h = hashlib.sha256()
+        h.update(midi_data)
+        try:
+            sf2_stat = SF2_PATH.stat()
+            sf2_identity = f"{SF2_PATH.name}:{sf2_stat.st_size}:{sf2_stat.st_mtime_ns}"
+        except OSError:
+            sf2_identity = f"{SF2_PATH.name}:missing"
+        h.update(sf2_identity.encode())
+        h.update(json.dumps(
+            {"sample_rate": sample_rate, "version": RENDER_CACHE_VERSION, **settings},
+            sort_keys=True
+        ).encode())
+        return h.hexdigest()
+    
+    def _disk_path(self, key: str) -> Path:
+        return self.disk_dir / f"{key}.pcm"
+    
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            pcm = self._memory.get(key)
+            if pcm is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return pcm
+        
+        if self.disk_dir is not None and self.disk_bytes > 0:
+            path = self._disk_path(key)
+            try:
+                pcm = path.read_bytes()
+                os.utime(path)
+            except OSError:
+                pcm = None
+            if pcm is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                    self._put_memory(key, pcm)
+                return pcm
+        
+        with self._lock:
+            self.misses += 1
+        return None
+    
+    def put(self, key: str, pcm: bytes):
+        with self._lock:
+            self._put_memory(key, pcm)
+        if self.disk_dir is not None and 0 < len(pcm) <= self.disk_bytes:
+            self._put_disk(key, pcm)
+    
+    def _put_memory(self, key: str, pcm: bytes):
+        if len(pcm) > self.memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_used -= len(old)
+        self._memory[key] = pcm
+        self._memory_used += len(pcm)
+        while self._memory_used > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_used -= len(evicted)
+            self.evictions += 1
+    
+    def _put_disk(self, key: str, pcm: bytes):
+        path = self._disk_path(key)
+        if path.exists():
+            return
+        tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        try:
+            tmp_path.write_bytes(pcm)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Render cache write failed: {e}")
+            tmp_path.unlink(missing_ok=True)
+            return
+        
+        with self._lock:
+            self._disk_used += len(pcm)
+            if self._disk_used <= self.disk_bytes:
+                return
+            # Over budget: drop least recently used files until we fit again
+            entries = []
+            for p in self.disk_dir.glob("*.pcm"):
+                try:
+                    st = p.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, p))
+            entries.sort()
+            self._disk_used = sum(size for _, size, _ in entries)
+            for _, size, p in entries:
+                if self._disk_used <= self.disk_bytes:
+                    break
+                p.unlink(missing_ok=True)
+                self._disk_used -= size
+                self.evictions += 1
+    
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_used,
+                "memory_budget_bytes": self.memory_bytes,
+                "disk_bytes": self._disk_used,
+                "disk_budget_bytes": self.disk_bytes,
+            }
+
+
+render_cache = RenderCache(RENDER_CACHE_MEMORY_BYTES, RENDER_CACHE_DIR, RENDER_CACHE_DISK_BYTES)
+
+
+# ============================================================================
+# GENERATION CACHE (seeded requests are pure functions of the request)
+# ============================================================================
+
+GENERATION_CACHE_SIZE = int(os.getenv("GENERATION_CACHE_SIZE", "256"))
+
+
+class GenerationCache:
+    """
+    LRU memo of generated MIDI for seeded requests.
+    
+    With a seed, build_melody_midi/build_drums_midi are pure functions of
+    the request, so the normalized request model is a complete key. Each entry
+    also remembers the render cache key of its audio once it has been rendered.
+    Unseeded requests are never cached.
+    """
+    
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def make_key(self, kind: str, req: BaseModel) -> Optional[str]:
+        if self.max_entries <= 0 or getattr(req, "seed", None) is None:
+            return None
+        return f"{kind}:{req.model_dump_json()}"
+    
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+    
+    def put(self, key: str, midi_data: bytes):
+        with self._lock:
+            self._entries[key] = {"midi": midi_data, "audio_key": None}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def attach_audio(self, key: str, audio_key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry["audio_key"] = audio_key
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+            }
+
+
+generation_cache = GenerationCache(GENERATION_CACHE_SIZE)
+
+
+@app.get("/stats")
+def stats():
+    """Render/cache counters for monitoring."""
+    return {
+        "render_cache": render_cache.stats(),
+        "generation_cache": generation_cache.stats(),
+        "note_cache": {rate: cache.stats() for rate, cache in _note_caches.items()},
+        "recent_transfers": list(manager.recent_transfers),
+        "serializer": manager.serializer.name,
+        "connections": {
+            manager.client_ids.get(ws, "?"): outbox.stats() for ws, outbox in manager.outboxes.items()
+        },
+    }
+
+
+# ============================================================================
+# MIDI TO AUDIO RENDERING (FluidSynth)
+# ============================================================================
+
+def stereo_to_mono_pcm16(samples) -> bytes:
+    """Downmix interleaved stereo int16 samples to mono PCM16 (little-endian) bytes."""
+    frames = np.asarray(samples, dtype=np.int16).reshape(-1, 2).astype(np.int32)
+    mono = (frames[:, 0] + frames[:, 1]) >> 1
+    return mono.astype("<i2").tobytes()
+
+
+@contextmanager
+def midi_input_path(midi_data: bytes):
+    """
+    Expose in-memory MIDI bytes as a path the fluidsynth CLI can open.
+    
+    Yields (path, fd_to_pass). On Linux the bytes live in an anonymous memfd
+    shared with the child process; elsewhere a temp file is used and removed
+    as soon as the render finishes.
+    """
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create("promptdj-midi")
+        try:
+            with os.fdopen(os.dup(fd), "wb") as f:
+                f.write(midi_data)
+            yield f"/dev/fd/{fd}", fd
+        finally:
+            os.close(fd)
+    else:
+        with tempfile.NamedTemporaryFile(suffix=".mid", prefix="render_") as f:
+            f.write(midi_data)
+            f.flush()
+            yield f.name, None
+
+
+def iter_midi_pcm16(midi_data: bytes, sample_rate: int = 48000, read_size: int = 65536):
+    """
+    Render MIDI bytes to mono PCM16, yielding bytes blocks as FluidSynth produces them.
+    
+    Uses the in-process synth pool when available, otherwise one FluidSynth
+    process that writes raw stereo s16le into a pipe which is read as it fills.
+    Either way the stereo output is downmixed with NumPy block by block - no WAV
+    file and no FFmpeg stage - so callers can forward audio before the render ends.
+    """
+    if not SF2_PATH.exists():
+        raise RuntimeError(f"SoundFont not found: {SF2_PATH}")
+    
+    pool = get_synth_pool(sample_rate)
+    if pool is not None:
+        midi = MidiFile(file=io.BytesIO(midi_data))
+        for block in pool.render_frames(midi):
+            yield stereo_to_mono_pcm16(block)
+        return
+    
+    with midi_input_path(midi_data) as (midi_path, midi_fd):
+        # Raw audio goes to a dedicated pipe rather than stdout, which also carries
+        # FluidSynth's banner and log output
+        read_fd, write_fd = os.pipe()
+        cmd = [
+            "fluidsynth",
+            "-ni",
+            "-T", "raw",                 # Headerless sample data
+            "-O", "s16",                 # 16-bit signed
+            "-E", "little",              # Little-endian
+            "-F", f"/dev/fd/{write_fd}",
+            "-r", str(sample_rate),
+            str(SF2_PATH.absolute()),
+            midi_path,
+        ]
+        
+        print(f"FluidSynth (raw PCM) command: {' '.join(cmd)}")
+        
+        try:
+            proc = subprocess.Popen(
+                cmd,
+                pass_fds=tuple(fd for fd in (write_fd, midi_fd) if fd is not None),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+        except OSError:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        
+        total = 0
+        try:
+            with os.fdopen(read_fd, "rb") as pipe:
+                pending = b""
+                while True:
+                    data = pipe.read1(read_size)
+                    if not data:
+                        break
+                    pending += data
+                    # Only whole stereo frames are downmixed; a split frame waits for the next read
+                    usable = len(pending) - len(pending) % 4
+                    if usable:
+                        total += usable
+                        yield stereo_to_mono_pcm16(np.frombuffer(pending[:usable], dtype="<i2"))
+                        pending = pending[usable:]
+            
+            try:
+                _, stderr = proc.communicate(timeout=120)
+            except subprocess.TimeoutExpired:
+                raise RuntimeError("FluidSynth rendering timed out")
+        finally:
+            # Also reached when the consumer abandons the stream early
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+    
+    if proc.returncode != 0 or not total:
+        raise RuntimeError(f"FluidSynth raw render failed. Return code: {proc.returncode}, stderr: {stderr.decode(errors='replace')}")
+
+
+def render_midi_to_pcm16(midi_data: bytes, sample_rate: int = 48000) -> bytes:
+    """Render MIDI bytes straight to mono PCM16 bytes in a single pass."""
+    return b"".join(iter_midi_pcm16(midi_data, sample_rate))
+
+
+def estimate_midi_samples(midi_data: bytes, sample_rate: int) -> int:
+    """Predict the rendered length in samples; FluidSynth stops at the last event."""
+    return int(round(MidiFile(file=io.BytesIO(midi_data)).length * sample_rate))
+
+
+def pcm16_result(pcm: bytes, sample_rate: int, cache_key: Optional[str] = None) -> dict:
+    """
+    Package mono PCM16 bytes in the dict shape send_audio_chunked expects.
+    
+    The PCM is kept as raw bytes (no copy); it is only base64-encoded per chunk,
+    at the edge, when a client uses the JSON transport.
+    """
+    return {
+        "pcm": pcm,
+        "sample_rate": sample_rate,
+        "channels": 1,
+        "sample_count": len(pcm) // 2,
+        "cache_key": cache_key
+    }
+
+
+def generate_audio_pcm16_from_midi(midi_data: bytes, sample_rate: int = 48000, use_cache: bool = True) -> dict:
+    """
+    Generate PCM16 audio from MIDI for Spectacles DynamicAudioOutput.
+    
+    Identical renders are served from the render cache unless use_cache is False.
+    
+    Returns dict with:
+    - pcm: raw PCM16 bytes (little-endian)
+    - sample_rate: 48000
+    - channels: 1 (mono)
+    - sample_count: number of samples
+    - cache_key: render cache key of the PCM
+    """
+    cache_key = RenderCache.make_key(midi_data, sample_rate, channels=1, gain=0.2)
+    pcm = render_cache.get(cache_key) if use_cache else None
+    
+    if pcm is None:
+        pcm = render_midi_to_pcm16(midi_data, sample_rate)
+        render_cache.put(cache_key, pcm)
+        print(f"PCM16 render: {len(pcm)} bytes, {len(pcm) // 2} samples @ {sample_rate}Hz")
+    else:
+        print(f"PCM16 cache hit: {len(pcm)} bytes ({cache_key[:12]})")
+    
+    return pcm16_result(pcm, sample_rate, cache_key)
+
+
+async def send_audio_chunk(websocket, manager, transfer_id: int, chunk_index: int,
+                           total_chunks: int, chunk_bytes):
+    """
+    Send one chunk of encoded audio (bytes or memoryview) over the connection's transport.
+    
+    Only this chunk is framed: header + payload for a binary frame, or base64
+    of just this chunk for the JSON transport (filled into a prebuilt message).
+    """
+    if manager.transport(websocket) == "binary":
+        await manager.send_bytes(websocket, BINARY_CHUNK_HEADER.pack(transfer_id, chunk_index) + chunk_bytes)
+    else:
+        text = manager.serializer.audio_chunk(chunk_index, total_chunks, chunk_bytes)
+        await manager.send_text(websocket, text, audio=True)
+
+
+async def send_audio_chunked(websocket, manager, pcm_data: dict, params: dict, chunk_size: int = 32768,
+                             segment_bounds: Optional[List[int]] = None):
+    """
+    Send PCM16 audio in chunks to avoid WebSocket message size limits on Spectacles.
+    
+    Audio is encoded with the connection's codec (PCM16 unless it negotiated
+    mu-law or IMA ADPCM) and cut on whole codec frames. Chunks are paced by the
+    connection's transfer pacer: a fixed 10 ms gap, or the credit window (with
+    adaptive chunk size) when the client negotiated flow control. audio_end
+    reports the transfer stats.
+    
+    With segment_bounds (sample offsets, e.g. bar lines) identical segments are
+    sent only once: the payload is the unique segments, each encoded on its
+    own, and audio_start["loop"] lists them with the arrangement to expand.
+    
+    Args:
+        websocket: WebSocket connection
+        manager: ConnectionManager
+        pcm_data: dict with pcm (raw bytes), sample_rate, channels, sample_count
+        params: dict with generation parameters
+        chunk_size: initial size of each chunk in bytes (before base64, ~32KB is safe)
+        segment_bounds: offsets to split the clip at for loop-aware transfer
+    """
+    codec = manager.codec(websocket)
+    content_hash = audio_content_hash(pcm_data["pcm"])
+    
+    if manager.client_has_audio(websocket, content_hash):
+        # The headset has this clip cached: announce it, send no chunks
+        await manager.send_json(websocket, {
+            "type": "audio_start",
+            "format": codec.name,
+            "sample_rate": pcm_data["sample_rate"],
+            "channels": pcm_data["channels"],
+            "sample_count": pcm_data["sample_count"],
+            "content_hash": content_hash,
+            "cached": True,
+            "num_chunks": 0,
+            "params": params
+        })
+        await manager.send_json(websocket, {
+            "type": "audio_end",
+            "total_chunks": 0,
+            "total_bytes": 0,
+            "content_hash": content_hash,
+            "cached": True
+        })
+        print(f"Client already has audio {content_hash}; no chunks sent")
+        return
+    
+    encoder = AudioEncoder(codec)
+    loop = None
+    if segment_bounds:
+        unique, arrangement = find_repeated_segments(pcm_data["pcm"], segment_bounds)
+        if len(unique) < len(arrangement):
+            pcm = memoryview(pcm_data["pcm"])
+            encoded = await run_render_job(
+                lambda: [AudioEncoder(codec).encode_all(pcm[start * 2:end * 2]) for start, end in unique]
+            )
+            loop = {
+                "segments": [
+                    {"sample_count": end - start, "bytes": len(data)}
+                    for (start, end), data in zip(unique, encoded)
+                ],
+                "arrangement": arrangement
+            }
+    
+    # Chunks are memoryview slices of the payload; PCM16 passes through as the
+    # rendered buffer itself, so nothing is copied
+    if loop is not None:
+        audio = memoryview(b"".join(encoded))
+    elif codec.name == "pcm16":
+        audio = memoryview(pcm_data["pcm"])
+    else:
+        audio = memoryview(await run_render_job(encoder.encode_all, pcm_data["pcm"]))
+    total_bytes = len(audio)
+    
+    pacer = manager.open_transfer(websocket, encoder.chunk_bytes(chunk_size))
+    transport = manager.transport(websocket)
+    
+    # Calculate number of chunks (exact unless flow control resizes them)
+    num_chunks = (total_bytes + pacer.chunk_size - 1) // pacer.chunk_size
+    
+    print(f"Sending audio in {num_chunks} chunks ({total_bytes} bytes total, {codec.name}, {transport}"
+          + (f", {len(loop['segments'])} unique of {len(loop['arrangement'])} segments)" if loop else ")"))
+    
+    start = {
+        "type": "audio_start",
+        "transfer_id": pacer.transfer_id,
+        "transport": transport,
+        "format": codec.name,
+        "codec": codec.describe(),
+        "sample_rate": pcm_data["sample_rate"],
+        "channels": pcm_data["channels"],
+        "sample_count": pcm_data["sample_count"],
+        "content_hash": content_hash,
+        "total_bytes": total_bytes,
+        "num_chunks": num_chunks,
+        "params": params
+    }
+    if loop is not None:
+        start["loop"] = loop
+    
+    # The payload is complete up front, so the transfer can be resumed from the start
+    bounds: List[tuple] = []
+    manager.remember_transfer(websocket, pacer.transfer_id, audio, start, bounds)
+    
+    try:
+        # Send audio_start message with metadata
+        await manager.send_json(websocket, start)
+        
+        # Send chunks (until done, or until the client replies have_audio)
+        offset = 0
+        while offset < total_bytes and not pacer.skipped:
+            await pacer.wait_for_credit()
+            if pacer.skipped:
+                break
+            size = encoder.chunk_bytes(pacer.chunk_size)
+            end = min(offset + size, total_bytes)
+            total_chunks = pacer.chunks + 1 + (total_bytes - end + size - 1) // size
+            bounds.append((offset, end))
+            await send_audio_chunk(websocket, manager, pacer.transfer_id, pacer.chunks, total_chunks, audio[offset:end])
+            await pacer.sent(end - offset)
+            offset = end
+    finally:
+        stats = manager.close_transfer(pacer)
+    
+    # Send audio_end message
+    await manager.send_json(websocket, {
+        "type": "audio_end",
+        "transfer_id": pacer.transfer_id,
+        "total_chunks": pacer.chunks,
+        "total_bytes": total_bytes,
+        "content_hash": content_hash,
+        "skipped": pacer.skipped,
+        "stats": stats
+    })
+    
+    print(f"Finished sending {pacer.chunks} audio chunks: {stats}")
+
+
+async def send_audio_stream(websocket, manager, blocks, estimated_samples: int, sample_rate: int,
+                            params: dict, chunk_size: int = 32768) -> bytes:
+    """
+    Send PCM16 audio in chunks while it is still being rendered.
+    
+    audio_start carries an estimated sample count (flagged with "streaming"),
+    each audio_chunk goes out as soon as a chunk's worth of bytes has
+    accumulated, and audio_end carries the final sample_count / total_chunks /
+    total_bytes and the transfer stats.
+    
+    Args:
+        blocks: async iterator of mono PCM16 bytes blocks
+        estimated_samples: predicted sample count for audio_start
+    
+    Returns the complete PCM16 bytes once the stream has finished.
+    """
+    codec = manager.codec(websocket)
+    encoder = AudioEncoder(codec)
+    estimated_bytes = -(-estimated_samples // codec.frame_samples) * codec.frame_bytes
+    pacer = manager.open_transfer(websocket, encoder.chunk_bytes(chunk_size))
+    estimated_chunks = (estimated_bytes + pacer.chunk_size - 1) // pacer.chunk_size
+    buffer = bytearray()
+    # Encoded bytes to send; for PCM16 that is the render buffer itself
+    wire = buffer if codec.name == "pcm16" else bytearray()
+    encoded = 0  # PCM16 bytes of buffer already handed to the encoder
+    sent = 0
+    bounds: List[tuple] = []
+    
+    async def send_ready(final: bool = False):
+        nonlocal sent
+        # The view is released before the buffer grows again
+        with memoryview(wire) as view:
+            while len(wire) - sent >= encoder.chunk_bytes(pacer.chunk_size) or (final and sent < len(wire)):
+                await pacer.wait_for_credit()
+                end = min(sent + encoder.chunk_bytes(pacer.chunk_size), len(wire))
+                bounds.append((sent, end))
+                await send_audio_chunk(websocket, manager, pacer.transfer_id, pacer.chunks,
+                                       max(estimated_chunks, pacer.chunks + 1), view[sent:end])
+                await pacer.sent(end - sent)
+                sent = end
+    
+    start = {
+        "type": "audio_start",
+        "transfer_id": pacer.transfer_id,
+        "transport": manager.transport(websocket),
+        "format": codec.name,
+        "codec": codec.describe(),
+        "sample_rate": sample_rate,
+        "channels": 1,
+        "sample_count": estimated_samples,
+        "estimated_sample_count": estimated_samples,
+        "total_bytes": estimated_bytes,
+        "num_chunks": estimated_chunks,
+        "streaming": True,
+        "params": params
+    }
+    
+    try:
+        await manager.send_json(websocket, start)
+        
+        async for block in blocks:
+            buffer += block
+            if wire is not buffer and len(buffer) - encoded >= STREAM_ENCODE_BYTES:
+                wire += await run_render_job(encoder.feed, bytes(buffer[encoded:]))
+                encoded = len(buffer)
+            await send_ready()
+        if wire is not buffer:
+            wire += await run_render_job(encoder.encode_all, bytes(buffer[encoded:]))
+        await send_ready(final=True)
+    finally:
+        stats = manager.close_transfer(pacer)
+    
+    pcm = bytes(buffer)
+    payload = pcm if wire is buffer else bytes(wire)
+    content_hash = audio_content_hash(pcm)
+    
+    # Only a finished render can be resumed; audio_start is replayed with the final sizes
+    manager.remember_transfer(websocket, pacer.transfer_id, payload, {
+        **start,
+        "sample_count": len(pcm) // 2,
+        "content_hash": content_hash,
+        "total_bytes": len(payload),
+        "num_chunks": pacer.chunks,
+        "streaming": False
+    }, bounds)
+    
+    await manager.send_json(websocket, {
+        "type": "audio_end",
+        "transfer_id": pacer.transfer_id,
+        "total_chunks": pacer.chunks,
+        "total_bytes": len(payload),
+        "sample_count": len(pcm) // 2,
+        "content_hash": content_hash,  # Not known before the render finishes
+        "streaming": True,
+        "stats": stats
+    })
+    
+    print(f"Finished streaming {pacer.chunks} audio chunks ({len(payload)} bytes, estimated {estimated_bytes}): {stats}")
+    return pcm
+
+
+async def deliver_audio(websocket, manager, pcm_data: dict, params: dict, **kwargs):
+    """
+    Send a rendered clip to the requesting connection and the rest of its room.
+    
+    One render is fanned out: every other member receives it as a job on its
+    own connection (so with its own transport, codec and flow control, after
+    whatever it is already receiving). Those jobs are started, not awaited -
+    the caller holds the requester's job lock, and waiting on a peer's lock
+    from there deadlocks two members generating at once. A member whose
+    transfer fails or exceeds ROOM_TRANSFER_TIMEOUT_SECONDS is evicted from
+    the room. A failure on the requesting connection is raised as before.
+    """
+    peers = manager.room_peers(websocket)
+    if not peers:
+        await send_audio_chunked(websocket, manager, pcm_data, params, **kwargs)
+        return
+    
+    room_params = {**params, "room": manager.member_rooms.get(websocket)}
+    
+    async def deliver(member):
+        if manager.member_rooms.get(member) != room_params["room"]:
+            return  # Left or was evicted while this clip waited its turn
+        try:
+            await asyncio.wait_for(
+                send_audio_chunked(member, manager, pcm_data, room_params, **kwargs),
+                ROOM_TRANSFER_TIMEOUT_SECONDS
+            )
+        except Exception as e:
+            await manager.evict_from_room(member, str(e) or type(e).__name__)
+    
+    # Peer jobs are tasks of their own connections: the requester disconnecting
+    # (cancelling its job) does not stop the other members getting the clip
+    for member in peers:
+        manager.start_job(member, deliver(member))
+    print(f"Fanned out {pcm_data['sample_count']} samples to {len(peers) + 1} room members")
+    await send_audio_chunked(websocket, manager, pcm_data, room_params, **kwargs)
+
+
+async def resume_audio_transfer(websocket, manager, entry: dict, chunk_indexes: Optional[List[int]] = None,
+                                from_chunk: int = 0, chunk_size: int = 32768):
+    """
+    Resend part of a remembered transfer to a reconnected client.
+    
+    Chunks keep their original index and byte range; the part of the payload
+    that was never sent is cut into new chunks after those. Sends the original
+    audio_start (flagged "resumed", with the chunk list), the chunks asked for
+    by index (or every chunk from from_chunk on), then audio_end.
+    """
+    payload = memoryview(entry["payload"])
+    encoder = AudioEncoder(AUDIO_CODECS[entry["start"]["format"]])
+    bounds = list(entry["bounds"])
+    offset = bounds[-1][1] if bounds else 0
+    while offset < len(payload):
+        end = min(offset + encoder.chunk_bytes(chunk_size), len(payload))
+        bounds.append((offset, end))
+        offset = end
+    
+    if chunk_indexes is None:
+        chunk_indexes = range(from_chunk, len(bounds))
+    wanted = sorted({i for i in chunk_indexes if 0 <= i < len(bounds)})
+    
+    transfer_id = entry["start"]["transfer_id"]
+    pacer = manager.open_transfer(websocket, chunk_size, transfer_id=transfer_id)
+    try:
+        await manager.send_json(websocket, {
+            **entry["start"],
+            "transport": manager.transport(websocket),
+            "num_chunks": len(bounds),
+            "resumed": True,
+            "chunks": wanted
+        })
+        for index in wanted:
+            await pacer.wait_for_credit()
+            start, end = bounds[index]
+            await send_audio_chunk(websocket, manager, transfer_id, index, len(bounds), payload[start:end])
+            await pacer.sent(end - start)
+    finally:
+        stats = manager.close_transfer(pacer)
+    
+    await manager.send_json(websocket, {
+        "type": "audio_end",
+        "transfer_id": transfer_id,
+        "total_chunks": len(bounds),
+        "total_bytes": len(payload),
+        "sample_count": entry["start"]["sample_count"],
+        "resumed": True,
+        "resent_chunks": len(wanted),
+        "stats": stats
+    })
+    
+    print(f"Resumed transfer {transfer_id}: resent {len(wanted)} of {len(bounds)} chunks")
+
+
+# In-memory MIDI builders per stem kind
+STEM_BUILDERS = {
+    "melody": build_melody_midi,
+    "drums": build_drums_midi,
+}
+
+
+def _cached_midi_bytes(kind: str, req: BaseModel, use_cache: bool) -> bytes:
+    key = generation_cache.make_key(kind, req) if use_cache else None
+    entry = generation_cache.get(key) if key is not None else None
+    if entry is not None:
+        return entry["midi"]
+    
+    midi_data = STEM_BUILDERS[kind](req)
+    if key is not None:
+        generation_cache.put(key, midi_data)
+    return midi_data
+
+
+def generate_midi_bytes(req: GenerateRequest, use_cache: bool = True) -> bytes:
+    """Generate melody MIDI and return as bytes (memoized for seeded requests)."""
+    return _cached_midi_bytes("melody", req, use_cache)
+
+
+def generate_drums_bytes(req: DrumifyRequest, use_cache: bool = True) -> bytes:
+    """Generate drums MIDI and return as bytes (memoized for seeded requests)."""
+    return _cached_midi_bytes("drums", req, use_cache)
+
+
+def lookup_stem(kind: str, req: BaseModel, sample_rate: int = 48000, use_cache: bool = True) -> tuple:
+    """
+    Look a stem request up in the generation and render caches.
+    
+    Returns (generation_key, midi_data, pcm_data); any of them may be None.
+    pcm_data is only set when the audio of a seeded request is still cached.
+    """
+    key = generation_cache.make_key(kind, req) if use_cache else None
+    entry = generation_cache.get(key) if key is not None else None
+    if entry is None:
+        return key, None, None
+    
+    if entry["audio_key"] is not None:
+        pcm = render_cache.get(entry["audio_key"])
+        if pcm is not None:
+            return key, entry["midi"], pcm16_result(pcm, sample_rate, entry["audio_key"])
+    return key, entry["midi"], None
+
+
+def render_stem(kind: str, req: BaseModel, midi_data: Optional[bytes] = None,
+                sample_rate: int = 48000, use_cache: bool = True) -> tuple:
+    """Generate a stem's MIDI (unless given) and render it. Returns (midi_data, pcm_data)."""
+    if midi_data is None:
+        midi_data = STEM_BUILDERS[kind](req)
+    return midi_data, render_stem_pcm16(kind, req, midi_data, sample_rate, use_cache=use_cache)
+
+
+def remember_stem(key: Optional[str], midi_data: bytes, pcm_data: dict):
+    """Record a freshly generated seeded stem in the generation cache."""
+    if key is None:
+        return
+    generation_cache.put(key, midi_data)
+    generation_cache.attach_audio(key, pcm_data["cache_key"])
+
+
+def generate_stem_audio(kind: str, req: BaseModel, sample_rate: int = 48000, use_cache: bool = True) -> dict:
+    """
+    Generate and render one stem ("melody" or "drums") to PCM16.
+    
+    A seeded request that was rendered before is answered straight from the
+    caches without running the generator or the renderer. Pass use_cache=False
+    to force a fresh generation and render.
+    """
+    key, midi_data, pcm_data = lookup_stem(kind, req, sample_rate, use_cache)
+    if pcm_data is not None:
+        return pcm_data
+    
+    midi_data, pcm_data = render_stem(kind, req, midi_data, sample_rate, use_cache)
+    remember_stem(key, midi_data, pcm_data)
+    return pcm_data
+
+
+# ============================================================================
+# SAMPLED RENDER ENGINES (pre-rendered one-shots mixed with NumPy)
+# ============================================================================
+
+# "samples" assembles drum stems from the one-shot bank; "fluidsynth" renders
+# the whole pattern through the synthesizer like any other MIDI
+DRUM_ENGINE = os.getenv("DRUM_ENGINE", "samples")
+
+# Velocities each drum voice is pre-rendered at. Hits use the nearest layer,
+# so ghost notes (40-60) and accents (80-110) keep their own timbre.
+DRUM_VELOCITY_LAYERS = (50, 80, 95, 110)
+
+# Longest one-shot kept per voice (trailing silence is trimmed)
+DRUM_ONESHOT_SECONDS = 2.0
+
+# Note length used by build_drums_midi (60 ticks), rendered at 120 BPM
+DRUM_GATE_TICKS = 60
+
+# GM exclusive class: a new hi-hat hit cuts the one still ringing
+DRUM_CHOKE_GROUPS = ({42, 44, 46},)
+CHOKE_FADE_SAMPLES = 96
+
+_drum_banks: Dict[int, Optional["DrumBank"]] = {}
+_drum_banks_lock = threading.Lock()
+
+
+def midi_note_events(midi_data: bytes) -> tuple:
+    """
+    Extract notes from MIDI bytes.
+    
+    Returns (ticks_per_beat, tempo, events) where events is a sorted list of
+    (absolute_tick, note, velocity, duration_ticks, channel) and tempo is the
+    first set_tempo value. Notes that are never released get a duration of 0.
+    """
+    mid = MidiFile(file=io.BytesIO(midi_data))
+    tempo = None
+    events = []
+    for track in mid.tracks:
+        tick = 0
+        sounding: Dict[tuple, int] = {}
+        for msg in track:
+            tick += msg.time
+            if msg.type == "set_tempo" and tempo is None:
+                tempo = msg.tempo
+            elif msg.type == "note_on" and msg.velocity > 0:
+                sounding[(msg.channel, msg.note)] = len(events)
+                events.append([tick, msg.note, msg.velocity, 0, msg.channel])
+            elif msg.type in ("note_on", "note_off"):
+                idx = sounding.pop((msg.channel, msg.note), None)
+                if idx is not None:
+                    events[idx][3] = tick - events[idx][0]
+    events.sort()
+    return mid.ticks_per_beat, tempo or 500000, [tuple(e) for e in events]
+
+
+def pcm16_from_float(mix) -> bytes:
+    """Round and clip a float mix to PCM16 little-endian bytes."""
+    return np.clip(np.rint(mix), -32768, 32767).astype("<i2").tobytes()
+
+
+class DrumBank:
+    """
+    Velocity-layered one-shots for every DRUM_MAP voice at one sample rate.
+    
+    Each (note, layer) is rendered once through FluidSynth when the bank is
+    built. Drum stems are then assembled by placing scaled one-shots at the
+    sample positions of the pattern's hits.
+    """
+    
+    engine = "drum_bank_v2"  # v2: hits placed relative to their bar line
+    
+    def __init__(self, sample_rate: int):
+        self.sample_rate = sample_rate
+        self.layers = np.array(DRUM_VELOCITY_LAYERS, dtype=np.float32)
+        self.shots: Dict[tuple, np.ndarray] = {}
+        for note in sorted(set(DRUM_MAP.values())):
+            for velocity in DRUM_VELOCITY_LAYERS:
+                self.shots[(note, velocity)] = self._render_shot(note, velocity)
+        self.choke_group = {note: i for i, group in enumerate(DRUM_CHOKE_GROUPS) for note in group}
+        print(f"🥁 Drum bank ready: {len(self.shots)} one-shots @ {sample_rate}Hz")
+    
+    def _render_shot(self, note: int, velocity: int) -> np.ndarray:
+        mid = MidiFile(ticks_per_beat=480)
+        track = MidiTrack()
+        mid.tracks.append(track)
+        track.append(MetaMessage("set_tempo", tempo=mido.bpm2tempo(120), time=0))
+        track.append(Message("note_on", note=note, velocity=velocity, time=0, channel=9))
+        track.append(Message("note_off", note=note, velocity=0, time=DRUM_GATE_TICKS, channel=9))
+        # Keep the renderer running until the tail has rung out (960 ticks/s @ 120 BPM)
+        track.append(MetaMessage("end_of_track", time=int(DRUM_ONESHOT_SECONDS * 960) - DRUM_GATE_TICKS))
+        
+        pcm = np.frombuffer(render_midi_to_pcm16(midi_to_bytes(mid), self.sample_rate), dtype="<i2")
+        audible = np.flatnonzero(np.abs(pcm) > 1)
+        end = int(audible[-1]) + 1 if len(audible) else 0
+        return pcm[:end].astype(np.float32)
+    
+    def render(self, midi_data: bytes, total_ticks: int) -> bytes:
+        """Assemble a drum stem from MIDI bytes, covering total_ticks of audio."""
+        ticks_per_beat, tempo, events = midi_note_events(midi_data)
+        samples_per_tick = tempo / 1_000_000 / ticks_per_beat * self.sample_rate
+        total = int(round(total_ticks * samples_per_tick))
+        mix = np.zeros(total, dtype=np.float32)
+        if not events:
+            return pcm16_from_float(mix)
+        
+        hits = np.array(events, dtype=np.int64)[:, :3]
+        # Bar line (rounded like bar_bounds) + offset in the bar, so a repeated
+        # bar has its hits at the same samples in every repeat
+        ticks_per_bar = 4 * ticks_per_beat
+        bars, in_bar = np.divmod(hits[:, 0], ticks_per_bar)
+        starts = (np.rint(bars * ticks_per_bar * samples_per_tick) + np.rint(in_bar * samples_per_tick)).astype(np.int64)
+        notes = hits[:, 1]
+        velocities = hits[:, 2].astype(np.float32)
+        
+        # Nearest velocity layer; the residual is applied as gain (FluidSynth's
+        # default velocity curve is roughly quadratic in amplitude)
+        layer_idx = np.abs(velocities[:, None] - self.layers[None, :]).argmin(axis=1)
+        layer_vel = self.layers[layer_idx]
+        gains = (velocities / layer_vel) ** 2
+        
+        lengths = np.array([len(self.shots.get((n, int(v)), ())) for n, v in zip(notes, layer_vel)], dtype=np.int64)
+        ends = np.minimum(starts + lengths, total)
+        
+        # Choke groups: a hit is cut off by the next hit in the same group
+        choked = np.zeros(len(hits), dtype=bool)
+        for group in range(len(DRUM_CHOKE_GROUPS)):
+            idx = np.flatnonzero([self.choke_group.get(int(n)) == group for n in notes])
+            if len(idx) > 1:
+                cut = starts[idx[1:]]
+                choked[idx[:-1]] = cut < ends[idx[:-1]]
+                ends[idx[:-1]] = np.minimum(ends[idx[:-1]], cut)
+        
+        for i in np.flatnonzero(ends > starts):
+            start, end = starts[i], ends[i]
+            segment = self.shots[(int(notes[i]), int(layer_vel[i]))][:end - start] * gains[i]
+            if choked[i]:
+                fade = min(CHOKE_FADE_SAMPLES, len(segment))
+                segment[len(segment) - fade:] *= np.linspace(1.0, 0.0, fade, dtype=np.float32)
+            mix[start:end] += segment
+        
+        return pcm16_from_float(mix)
+
+
+def get_drum_bank(sample_rate: int = 48000) -> Optional[DrumBank]:
+    """
+    Return the one-shot bank for a sample rate, building it on first use.
+    
+    Only used with the in-process synth pool: building it through the CLI would
+    start one fluidsynth process (and SoundFont load) per one-shot.
+    """
+    if DRUM_ENGINE != "samples" or get_synth_pool(sample_rate) is None:
+        return None
+    
+    with _drum_banks_lock:
+        if sample_rate not in _drum_banks:
+            try:
+                _drum_banks[sample_rate] = DrumBank(sample_rate)
+            except Exception as e:
+                print(f"Drum bank unavailable @ {sample_rate}Hz, rendering drums with FluidSynth: {e}")
+                _drum_banks[sample_rate] = None
+        return _drum_banks[sample_rate]
+
+
+# "samples" overlap-adds cached note renders; "fluidsynth" renders every melody in full
+MELODY_ENGINE = os.getenv("MELODY_ENGINE", "samples")
+
+# Memory for cached (pitch, velocity bucket, duration, tempo) renders, per sample
+# rate. Notes are kept as int16; a half note at 120 BPM with its release is ~240 KB.
+NOTE_CACHE_BYTES = int(os.getenv("NOTE_CACHE_MB", "32")) * 1024 * 1024
+
+# Velocities are rendered at the centre of buckets this wide
+NOTE_VELOCITY_BUCKET = 8
+
+# Release tail rendered after each note-off
+NOTE_RELEASE_SECONDS = 1.5
+
+_note_caches: Dict[int, "NoteSampleCache"] = {}
+_note_caches_lock = threading.Lock()
+
+
+class NoteSampleCache:
+    """
+    Melody renderer backed by an LRU of single-note renders.
+    
+    build_melody_midi draws pitches from one scale and durations from five
+    fixed values, so the set of distinct notes is small. Each one is rendered
+    through FluidSynth (with its release tail) the first time it is needed and
+    overlap-added into the output buffer from then on. The LRU is bounded by
+    bytes, like the render cache.
+    """
+    
+    engine = "note_cache"
+    
+    def __init__(self, sample_rate: int, max_bytes: int):
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self._notes: "OrderedDict[tuple, np.ndarray]" = OrderedDict()
+        self._used = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def _render_note(self, channel: int, pitch: int, velocity: int, duration_ticks: int,
+                     tempo: int, ticks_per_beat: int) -> np.ndarray:
+        mid = MidiFile(ticks_per_beat=ticks_per_beat)
+        track = MidiTrack()
+        mid.tracks.append(track)
+        track.append(MetaMessage("set_tempo", tempo=tempo, time=0))
+        track.append(Message("note_on", note=pitch, velocity=velocity, time=0, channel=channel))
+        track.append(Message("note_off", note=pitch, velocity=0, time=duration_ticks, channel=channel))
+        release_ticks = int(NOTE_RELEASE_SECONDS * 1_000_000 / tempo * ticks_per_beat)
+        track.append(MetaMessage("end_of_track", time=release_ticks))
+        
+        pcm = np.frombuffer(render_midi_to_pcm16(midi_to_bytes(mid), self.sample_rate), dtype="<i2")
+        audible = np.flatnonzero(np.abs(pcm) > 1)
+        end = int(audible[-1]) + 1 if len(audible) else 0
+        return pcm[:end].copy()
+    
+    def get_note(self, channel: int, pitch: int, velocity: int, duration_ticks: int,
+                 tempo: int, ticks_per_beat: int) -> np.ndarray:
+        key = (channel, pitch, velocity, duration_ticks, tempo, ticks_per_beat)
+        with self._lock:
+            samples = self._notes.get(key)
+            if samples is not None:
+                self._notes.move_to_end(key)
+                self.hits += 1
+                return samples
+            self.misses += 1
+        
+        samples = self._render_note(channel, pitch, velocity, duration_ticks, tempo, ticks_per_beat)
+        if samples.nbytes > self.max_bytes:
+            return samples
+        with self._lock:
+            old = self._notes.pop(key, None)
+            if old is not None:
+                self._used -= old.nbytes
+            self._notes[key] = samples
+            self._used += samples.nbytes
+            while self._used > self.max_bytes:
+                _, evicted = self._notes.popitem(last=False)
+                self._used -= evicted.nbytes
+                self.evictions += 1
+        return samples
+    
+    def render(self, midi_data: bytes, total_ticks: int) -> bytes:
+        """Overlap-add cached note renders into a buffer covering total_ticks."""
+        ticks_per_beat, tempo, events = midi_note_events(midi_data)
+        samples_per_tick = tempo / 1_000_000 / ticks_per_beat * self.sample_rate
+        total = int(round(total_ticks * samples_per_tick))
+        mix = np.zeros(total, dtype=np.float32)
+        
+        for tick, pitch, velocity, duration, channel in events:
+            start = int(round(tick * samples_per_tick))
+            if start >= total or duration <= 0:
+                continue
+            bucket_velocity = min(127, velocity // NOTE_VELOCITY_BUCKET * NOTE_VELOCITY_BUCKET + NOTE_VELOCITY_BUCKET // 2)
+            note = self.get_note(channel, pitch, bucket_velocity, duration, tempo, ticks_per_beat)
+            n = min(len(note), total - start)
+            mix[start:start + n] += note[:n] * np.float32((velocity / bucket_velocity) ** 2)
+        
+        return pcm16_from_float(mix)
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._notes),
+                "bytes": self._used,
+            }
+
+
+def get_note_cache(sample_rate: int = 48000) -> Optional[NoteSampleCache]:
+    """
+    Return the note sample cache for a sample rate.
+    
+    Only used with the in-process synth pool: filling it through the CLI would
+    cost one process per distinct note.
+    """
+    if MELODY_ENGINE != "samples" or get_synth_pool(sample_rate) is None:
+        return None
+    
+    with _note_caches_lock:
+        if sample_rate not in _note_caches:
+            _note_caches[sample_rate] = NoteSampleCache(sample_rate, NOTE_CACHE_BYTES)
+        return _note_caches[sample_rate]
+
+
+def get_stem_sampler(kind: str, sample_rate: int = 48000):
+    """Return the sampled engine for a stem kind, or None if FluidSynth must render it."""
+    if kind == "drums":
+        return get_drum_bank(sample_rate)
+    if kind == "melody":
+        return get_note_cache(sample_rate)
+    return None
+
+
+def render_stem_pcm16(kind: str, req: BaseModel, midi_data: bytes, sample_rate: int = 48000,
+                      use_cache: bool = True) -> dict:
+    """
+    Render a generated stem to PCM16 with the fastest engine available for it.
+    
+    Drums go through the one-shot bank and melodies through the note sample
+    cache when their engine is "samples"; anything else (or an unavailable
+    engine) is rendered by FluidSynth.
+    """
+    sampler = get_stem_sampler(kind, sample_rate)
+    if sampler is None:
+        return generate_audio_pcm16_from_midi(midi_data, sample_rate, use_cache=use_cache)
+    
+    total_ticks = req.bars * 4 * 480
+    cache_key = RenderCache.make_key(midi_data, sample_rate, channels=1, engine=sampler.engine, total_ticks=total_ticks)
+    pcm = render_cache.get(cache_key) if use_cache else None
+    if pcm is None:
+        pcm = sampler.render(midi_data, total_ticks)
+        render_cache.put(cache_key, pcm)
+    return pcm16_result(pcm, sample_rate, cache_key)
+
+
+# ============================================================================
+# STEM MIXDOWN
+# ============================================================================
+
+# Gain applied to every stem before summing (~-3 dB of headroom per stem)
+MIX_STEM_GAIN = 0.7
+
+# Peak limiter: ceiling (~-1 dBFS), analysis block size and release time
+LIMITER_CEILING = 0.89 * 32767
+LIMITER_BLOCK = 256
+LIMITER_RELEASE_SECONDS = 0.25
+
+
+def bar_grid_samples(tempo_bpm: int, bars: int, sample_rate: int = 48000) -> int:
+    """Number of samples in `bars` bars of 4/4 at the MIDI file's tempo."""
+    return int(round(bars * 4 * mido.bpm2tempo(tempo_bpm) / 1_000_000 * sample_rate))
+
+
+def bar_bounds(tempo_bpm: int, total_samples: int, sample_rate: int = 48000) -> List[int]:
+    """Sample offsets of every bar line in a clip, plus its end."""
+    bounds = [0]
+    while bounds[-1] < total_samples:
+        bounds.append(min(bar_grid_samples(tempo_bpm, len(bounds), sample_rate), total_samples))
+    return bounds
+
+
+def find_repeated_segments(pcm, bounds: List[int]) -> tuple:
+    """
+    Split mono PCM16 at the sample offsets in `bounds` and collapse identical segments.
+    
+    Returns (unique segments as (start, end) sample ranges, arrangement), where
+    the clip is the unique segments concatenated in arrangement order.
+    """
+    audio = memoryview(pcm)
+    unique: List[tuple] = []
+    index_of: Dict[bytes, int] = {}
+    arrangement = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        digest = hashlib.blake2b(audio[start * 2:end * 2], digest_size=16).digest() + (end - start).to_bytes(8, "little")
+        if digest not in index_of:
+            index_of[digest] = len(unique)
+            unique.append((start, end))
+        arrangement.append(index_of[digest])
+    return unique, arrangement
+
+
+def limit_peaks(mix: np.ndarray, sample_rate: int = 48000) -> np.ndarray:
+    """
+    Simple look-ahead peak limiter.
+    
+    Block peaks give a target gain that attacks instantly one block early and
+    recovers linearly over LIMITER_RELEASE_SECONDS; the block gains are then
+    interpolated per sample.
+    """
+    n = len(mix)
+    if n == 0:
+        return mix
+    
+    blocks = -(-n // LIMITER_BLOCK)
+    padded = np.zeros(blocks * LIMITER_BLOCK, dtype=np.float32)
+    padded[:n] = np.abs(mix)
+    peaks = padded.reshape(blocks, LIMITER_BLOCK).max(axis=1)
+    gain = np.minimum(1.0, LIMITER_CEILING / np.maximum(peaks, 1.0))
+    
+    # Look ahead one block so the gain is already down when the peak arrives
+    gain[:-1] = np.minimum(gain[:-1], gain[1:])
+    
+    # Instant attack, linear release: g[i] = min over j <= i of (gain[j] + (i - j) * step)
+    step = LIMITER_BLOCK / (LIMITER_RELEASE_SECONDS * sample_rate)
+    idx = np.arange(blocks)
+    smoothed = np.minimum(np.minimum.accumulate(gain - idx * step) + idx * step, 1.0)
+    
+    centers = idx * LIMITER_BLOCK + LIMITER_BLOCK / 2
+    return mix * np.interp(np.arange(n), centers, smoothed).astype(np.float32)
+
+
+def mix_stems(stems: List[bytes], total_samples: int, sample_rate: int = 48000) -> bytes:
+    """Sum mono PCM16 stems on a shared grid of total_samples with headroom and limiting."""
+    mix = np.zeros(total_samples, dtype=np.float32)
+    for pcm in stems:
+        samples = np.frombuffer(pcm, dtype="<i2")[:total_samples]
+        mix[:len(samples)] += samples
+    mix *= MIX_STEM_GAIN
+    return pcm16_from_float(limit_peaks(mix, sample_rate))
+
+
+def mix_stem_audio(stems: List[dict], tempo_bpm: int, bars: int, sample_rate: int = 48000) -> dict:
+    """
+    Mix rendered stems (pcm16_result dicts) into one buffer aligned to the bar grid.
+    
+    Every stem starts on bar one; the mix is padded or trimmed to exactly `bars` bars.
+    """
+    total_samples = bar_grid_samples(tempo_bpm, bars, sample_rate)
+    mixed = mix_stems([stem["pcm"] for stem in stems], total_samples, sample_rate)
+    return pcm16_result(mixed, sample_rate)
+
+
+# ============================================================================
+# RENDER JOBS (keep FluidSynth/FFmpeg off the event loop)
+# ============================================================================
+
+# Worker threads for generate/render jobs. The heavy lifting happens in FluidSynth
+# (in-process or a subprocess), which releases the GIL, so threads keep the loop free.
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "4"))
+render_executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+
+
+# Worker processes for rendering several stems at once. generate_both renders at
+# most two stems, so more workers only help concurrent clients. Each worker holds
+# its own SoundFont, drum bank, render-cache memory tier (RENDER_CACHE_MEMORY_MB)
+# and note cache (NOTE_CACHE_MB); they are started and warmed at startup.
+STEM_WORKERS = int(os.getenv("STEM_WORKERS", "2"))
+
+_stem_executor: Optional[ProcessPoolExecutor] = None
+_stem_ready = None  # Queue each worker's initializer reports its pid on once warm
+
+
+async def run_render_job(func, *args, **kwargs):
+    """Run a blocking generate/render function on the render executor and await it."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(render_executor, functools.partial(func, *args, **kwargs))
+
+
+async def iterate_render_job(gen_func, *args, **kwargs):
+    """
+    Drive a blocking generator on the render executor and yield its items here.
+    
+    Items are handed to the event loop as they are produced. If the consumer
+    stops early (e.g. the client disconnected) the generator is closed on its
+    next item, which stops the render it drives.
+    """
+    loop = asyncio.get_running_loop()
+    items: asyncio.Queue = asyncio.Queue()
+    stop = threading.Event()
+    done = object()
+    
+    def produce():
+        gen = gen_func(*args, **kwargs)
+        try:
+            for item in gen:
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(items.put_nowait, (item, None))
+        except Exception as e:
+            loop.call_soon_threadsafe(items.put_nowait, (done, e))
+            return
+        finally:
+            gen.close()
+        loop.call_soon_threadsafe(items.put_nowait, (done, None))
+    
+    job = loop.run_in_executor(render_executor, produce)
+    try:
+        while True:
+            item, error = await items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+        await asyncio.shield(job)
+
+
+async def stream_stem_audio(websocket, manager, kind: str, req: BaseModel, params: dict,
+                            sample_rate: int = 48000, use_cache: bool = True) -> dict:
+    """
+    Generate a stem and stream it to the client while FluidSynth is rendering.
+    
+    Only a full FluidSynth render is streamed progressively. Cached stems and
+    stems assembled by a sampled engine are ready in milliseconds and are sent
+    with send_audio_chunked. Returns the pcm_data of the finished stem.
+    """
+    key, midi_data, pcm_data = lookup_stem(kind, req, sample_rate, use_cache)
+    if pcm_data is None and get_stem_sampler(kind, sample_rate) is not None:
+        midi_data, pcm_data = await run_render_job(render_stem, kind, req, midi_data, sample_rate, use_cache)
+        remember_stem(key, midi_data, pcm_data)
+    if pcm_data is not None:
+        await send_audio_chunked(websocket, manager, pcm_data, params)
+        return pcm_data
+    
+    if midi_data is None:
+        midi_data = await run_render_job(lambda: STEM_BUILDERS[kind](req))
+    
+    cache_key = RenderCache.make_key(midi_data, sample_rate, channels=1, gain=0.2)
+    pcm = render_cache.get(cache_key) if use_cache else None
+    if pcm is not None:
+        pcm_data = pcm16_result(pcm, sample_rate, cache_key)
+        await send_audio_chunked(websocket, manager, pcm_data, params)
+    else:
+        estimated_samples = estimate_midi_samples(midi_data, sample_rate)
+        blocks = iterate_render_job(iter_midi_pcm16, midi_data, sample_rate)
+        try:
+            pcm = await send_audio_stream(websocket, manager, blocks, estimated_samples, sample_rate, params)
+        finally:
+            await blocks.aclose()
+        render_cache.put(cache_key, pcm)
+        pcm_data = pcm16_result(pcm, sample_rate, cache_key)
+    
+    remember_stem(key, midi_data, pcm_data)
+    return pcm_data
+
+
+def _init_stem_worker(ready):
+    """Process-pool initializer: one synth per worker, warmed before the first stem."""
+    global FLUIDSYNTH_POOL_SIZE
+    FLUIDSYNTH_POOL_SIZE = 1
+    get_synth_pool(48000)
+    get_drum_bank(48000)
+    ready.put(os.getpid())
+
+
+def _start_stem_worker() -> int:
+    """No-op task; the pool starts a worker (running its initializer) per waiting task."""
+    return os.getpid()
+
+
+def get_stem_executor() -> Optional[ProcessPoolExecutor]:
+    """Return the stem process pool, or None when STEM_WORKERS disables it."""
+    global _stem_executor, _stem_ready
+    if STEM_WORKERS <= 1:
+        return None
+    if _stem_executor is None:
+        # spawn: forking a process that runs synth and executor threads is unsafe
+        context = multiprocessing.get_context("spawn")
+        _stem_ready = context.Queue()
+        _stem_executor = ProcessPoolExecutor(
+            max_workers=STEM_WORKERS,
+            mp_context=context,
+            initializer=_init_stem_worker,
+            initargs=(_stem_ready,),
+        )
+    return _stem_executor
+
+
+def reset_stem_executor():
+    """Drop a broken stem pool; the next get_stem_executor() builds a new one."""
+    global _stem_executor
+    if _stem_executor is not None:
+        _stem_executor.shutdown(wait=False, cancel_futures=True)
+        _stem_executor = None
+
+
+@app.on_event("startup")
+async def warm_stem_workers():
+    """Start the stem workers and wait until each has loaded its synth."""
+    executor = get_stem_executor()
+    if executor is None:
+        return
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(executor, _start_stem_worker) for _ in range(STEM_WORKERS)))
+    pids = set()
+    try:
+        while len(pids) < STEM_WORKERS:
+            pids.add(await loop.run_in_executor(render_executor, _stem_ready.get, True, 60))
+    except queue.Empty:
+        pass  # A slow worker finishes warming in the background
+    print(f"🎛️ Stem workers ready: {len(pids)} of {STEM_WORKERS} process(es)")
+
+
+async def render_stems(stems: Dict[str, tuple], sample_rate: int = 48000, use_cache: bool = True) -> Dict[str, dict]:
+    """
+    Generate and render several stems concurrently.
+    
+    `stems` maps a name to (kind, request). Cached stems are answered in this
+    process; the rest run in parallel on the stem process pool (or on the render
+    threads when the pool is disabled), so the wall-clock time is that of the
+    slowest stem. Returns name -> pcm_data.
+    """
+    results: Dict[str, dict] = {}
+    pending = []
+    for name, (kind, req) in stems.items():
+        key, midi_data, pcm_data = lookup_stem(kind, req, sample_rate, use_cache)
+        if pcm_data is not None:
+            results[name] = pcm_data
+        else:
+            pending.append((name, kind, req, key, midi_data))
+    
+    if pending:
+        loop = asyncio.get_running_loop()
+        
+        def submit():
+            executor = get_stem_executor() or render_executor
+            return asyncio.gather(*[
+                loop.run_in_executor(
+                    executor,
+                    functools.partial(render_stem, kind, req, midi_data, sample_rate=sample_rate, use_cache=use_cache)
+                )
+                for _, kind, req, _, midi_data in pending
+            ])
+        
+        try:
+            rendered = await submit()
+        except BrokenProcessPool as e:
+            # A worker died (e.g. killed for memory); rebuild the pool and retry once
+            print(f"⚠️ Stem pool broken ({e}); restarting it")
+            reset_stem_executor()
+            try:
+                rendered = await submit()
+            except BrokenProcessPool:
+                reset_stem_executor()
+                raise
+        for (name, _, _, key, _), (midi_data, pcm_data) in zip(pending, rendered):
+            remember_stem(key, midi_data, pcm_data)
+            results[name] = pcm_data
+    
+    return results
+
+
+@app.on_event("shutdown")
+def shutdown_stem_executor():
+    if _stem_executor is not None:
+        _stem_executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Actions that generate and send audio; they run as background jobs
+GENERATE_ACTIONS = ("generate_melody", "generate_drums", "generate_both")
+
+
+async def handle_generate(websocket: WebSocket, action: str, params: dict, state: dict):
+    """Run one generate_* action for a Spectacles connection and send the audio."""
+    if action == "generate_melody":
+        # Generate melody with current or provided params
+        req = GenerateRequest(
+            tempo_bpm=params.get("tempo_bpm", state.get("tempo_bpm", 120)),
+            bars=params.get("bars", 8),
+            scale=params.get("scale", state.get("scale", "C_major")),
+            density=params.get("density", state.get("density", 0.55)),
+            variation=params.get("variation", state.get("variation", 0.35)),
+            seed=params.get("seed"),
+            generator=params.get("generator", "random")
+        )
+        
+        await manager.send_json(websocket, {"type": "status", "message": "Generating melody..."})
+        
+        try:
+            # Generate MIDI and render to PCM16 audio for Spectacles DynamicAudioOutput
+            # (seeded requests are answered from the caches unless use_cache is false)
+            send_params = {
+                "tempo_bpm": req.tempo_bpm,
+                "bars": req.bars,
+                "scale": req.scale,
+                "density": req.density,
+                "variation": req.variation
+            }
+            if params.get("stream", False) and not manager.room_peers(websocket):
+                # Chunks go out while FluidSynth is still rendering (single listener only)
+                pcm_data = await stream_stem_audio(
+                    websocket, manager, "melody", req, send_params,
+                    sample_rate=48000, use_cache=params.get("use_cache", True)
+                )
+            else:
+                pcm_data = await run_render_job(
+                    generate_stem_audio, "melody", req,
+                    sample_rate=48000, use_cache=params.get("use_cache", True)
+                )
+                
+                # Send PCM16 audio in chunks (for DynamicAudioOutput on Spectacles)
+                await deliver_audio(websocket, manager, pcm_data, send_params)
+            print(f"Sent PCM16 audio: {pcm_data['sample_count']} samples @ {pcm_data['sample_rate']}Hz")
+        except Exception as e:
+            print(f"Error generating melody: {e}")
+            import traceback
+            traceback.print_exc()
+            await manager.send_json(websocket, {"type": "error", "message": str(e)})
+    
+    elif action == "generate_drums":
+        # Generate drums with current or provided params
+        req = DrumifyRequest(
+            tempo_bpm=params.get("tempo_bpm", state.get("tempo_bpm", 120)),
+            bars=params.get("bars", 4),
+            style=params.get("style", state.get("drum_style", "techno")),
+            swing=params.get("swing", state.get("swing", 0.0)),
+            seed=params.get("seed"),
+            loop_bars=params.get("loop_bars")
+        )
+        
+        await manager.send_json(websocket, {"type": "status", "message": "Generating drums..."})
+        
+        try:
+            # Generate MIDI and render to PCM16 audio for Spectacles DynamicAudioOutput
+            # (seeded requests are answered from the caches unless use_cache is false)
+            send_params = {
+                "tempo_bpm": req.tempo_bpm,
+                "bars": req.bars,
+                "style": req.style,
+                "swing": req.swing,
+                "loop_bars": req.loop_bars
+            }
+            if params.get("stream", False) and not manager.room_peers(websocket):
+                # Chunks go out while FluidSynth is still rendering (single listener only)
+                pcm_data = await stream_stem_audio(
+                    websocket, manager, "drums", req, send_params,
+                    sample_rate=48000, use_cache=params.get("use_cache", True)
+                )
+            else:
+                pcm_data = await run_render_job(
+                    generate_stem_audio, "drums", req,
+                    sample_rate=48000, use_cache=params.get("use_cache", True)
+                )
+                
+                # Send PCM16 audio in chunks (for DynamicAudioOutput on Spectacles).
+                # A client that can expand loops gets each repeated bar only once.
+                segment_bounds = None
+                if params.get("loop_transfer", False):
+                    segment_bounds = bar_bounds(req.tempo_bpm, pcm_data["sample_count"], pcm_data["sample_rate"])
+                await deliver_audio(websocket, manager, pcm_data, send_params, segment_bounds=segment_bounds)
+            print(f"Sent PCM16 drums: {pcm_data['sample_count']} samples @ {pcm_data['sample_rate']}Hz")
+        except Exception as e:
+            print(f"Error generating drums: {e}")
+            import traceback
+            traceback.print_exc()
+            await manager.send_json(websocket, {"type": "error", "message": str(e)})
+    
+    elif action == "generate_both":
+        # Generate both melody and drums
+        melody_req = GenerateRequest(
+            tempo_bpm=params.get("tempo_bpm", state.get("tempo_bpm", 120)),
+            bars=params.get("bars", 8),
+            scale=params.get("scale", state.get("scale", "C_major")),
+            density=params.get("density", state.get("density", 0.55)),
+            variation=params.get("variation", state.get("variation", 0.35)),
+            generator=params.get("generator", "random")
+        )
+        drums_req = DrumifyRequest(
+            tempo_bpm=params.get("tempo_bpm", state.get("tempo_bpm", 120)),
+            bars=params.get("bars", 8),
+            style=params.get("style", state.get("drum_style", "techno")),
+            swing=params.get("swing", state.get("swing", 0.0))
+        )
+        
+        await manager.send_json(websocket, {"type": "status", "message": "Generating melody + drums..."})
+        
+        try:
+            # Generate and render both stems in parallel
+            stems = await render_stems(
+                {"melody": ("melody", melody_req), "drums": ("drums", drums_req)},
+                sample_rate=48000, use_cache=params.get("use_cache", True)
+            )
+            melody_pcm = stems["melody"]
+            drums_pcm = stems["drums"]
+            
+            # Mix melody + drums on the bar grid into a single PCM stream
+            await manager.send_json(websocket, {"type": "status", "message": "Mixing..."})
+            mix_pcm = await run_render_job(
+                mix_stem_audio, [melody_pcm, drums_pcm], melody_req.tempo_bpm, melody_req.bars, sample_rate=48000
+            )
+            
+            send_params = {
+                "tempo_bpm": melody_req.tempo_bpm,
+                "bars": melody_req.bars,
+                "scale": melody_req.scale,
+                "drum_style": drums_req.style
+            }
+            await deliver_audio(websocket, manager, mix_pcm, {**send_params, "layer": "combined"})
+            print(f"Sent PCM16 mix: {mix_pcm['sample_count']} samples")
+            
+            # Optionally send the stems too, for separate AudioLayerManager layers
+            if params.get("send_stems", False):
+                await deliver_audio(websocket, manager, melody_pcm, {**send_params, "layer": "melody"})
+                await deliver_audio(websocket, manager, drums_pcm, {**send_params, "layer": "drums"})
+            
+        except Exception as e:
+            print(f"Error generating both: {e}")
+            import traceback
+            traceback.print_exc()
+            await manager.send_json(websocket, {"type": "error", "message": str(e)})
+
+
+async def handle_client_message(websocket: WebSocket, client_id: str, data: dict):
+    """Act on one decoded message from a Spectacles client."""
+    action = data.get("action", "")
+    params = data.get("params", {})
+    
+    # Update client state
+    state = manager.client_states.get(client_id, {})
+    
+    if action == "ping":
+        await manager.send_json(websocket, {"type": "pong", "timestamp": datetime.now().isoformat()})
+    
+    elif action == "update_params":
+        # Update stored parameters
+        for key, value in params.items():
+            if key in state:
+                state[key] = value
+        manager.client_states[client_id] = state
+        await manager.send_json(websocket, {
+            "type": "params_updated",
+            "state": state
+        })
+    
+    elif action == "set_transport":
+        # Opt in to binary audio frames; the JSON transport stays the default
+        try:
+            manager.set_transport(websocket, params.get("transport", "json"))
+        except ValueError as e:
+            await manager.send_json(websocket, {"type": "error", "message": str(e)})
+            return
+        await manager.send_json(websocket, {
+            "type": "transport_set",
+            "transport": manager.transport(websocket)
+        })
+    
+    elif action == "set_codec":
+        # Opt in to a compact codec (mulaw 2:1, ima_adpcm ~4:1); PCM16 stays the default
+        try:
+            manager.set_codec(websocket, params.get("codec", "pcm16"))
+        except ValueError as e:
+            await manager.send_json(websocket, {"type": "error", "message": str(e)})
+            return
+        await manager.send_json(websocket, {
+            "type": "codec_set",
+            "codec": manager.codec(websocket).describe()
+        })
+    
+    elif action == "set_flow_control":
+        # Opt in to credit-based flow control: the client acks chunks with audio_ack
+        window = params.get("window", FLOW_DEFAULT_WINDOW)
+        manager.set_flow_control(websocket, window)
+        await manager.send_json(websocket, {
+            "type": "flow_control_set",
+            "window": manager.flow_windows.get(websocket, 0),
+            "min_chunk_bytes": FLOW_MIN_CHUNK,
+            "max_chunk_bytes": FLOW_MAX_CHUNK
+        })
+    
+    elif action == "audio_ack":
+        # Cumulative ack: every chunk up to chunk_index of transfer_id has arrived.
+        # No reply - acks are frequent and only feed the sender's credit window.
+        manager.ack(websocket, params.get("transfer_id"), params.get("chunk_index", -1), params.get("window"))
+    
+    elif action == "join_room":
+        # Share renders: whatever a member generates is sent to the whole room
+        room = str(params.get("room", "")).strip()
+        if not room:
+            await manager.send_json(websocket, {"type": "error", "message": "join_room needs a room name"})
+            return
+        manager.join_room(websocket, room)
+        await manager.announce_room(room)
+    
+    elif action == "leave_room":
+        room = manager.leave_room(websocket)
+        await manager.send_json(websocket, {"type": "room_left", "room": room})
+        if room is not None:
+            await manager.announce_room(room)
+    
+    elif action == "have_audio":
+        # The client has these clips cached ("hashes"), e.g. listed on connect,
+        # or replies to an audio_start whose content_hash it already has
+        # ("transfer_id" + "content_hash"), which stops that transfer.
+        # "evicted" lists clips it no longer has.
+        hashes = list(params.get("hashes", []))
+        if params.get("content_hash"):
+            hashes.append(params["content_hash"])
+        manager.add_known_audio(client_id, hashes)
+        manager.forget_known_audio(client_id, params.get("evicted", []))
+        if params.get("transfer_id") is not None:
+            manager.skip_transfer(websocket, params["transfer_id"])
+    
+    elif action == "resume":
+        # Resend chunks of a transfer that broke off (typically after a reconnect)
+        entry = manager.find_transfer(client_id, params.get("transfer_id"))
+        if entry is None:
+            await manager.send_json(websocket, {
+                "type": "error",
+                "message": f"Transfer {params.get('transfer_id')} is no longer available; generate it again",
+                "code": "resume_unavailable",
+                "transfer_id": params.get("transfer_id")
+            })
+            return
+        manager.start_job(websocket, resume_audio_transfer(
+            websocket, manager, entry,
+            chunk_indexes=params.get("chunks"),
+            from_chunk=params.get("from_chunk", 0)
+        ))
+    
+    elif action in GENERATE_ACTIONS:
+        # Generation runs as a background job so the loop keeps receiving
+        # (audio_ack messages arrive while the audio is being sent)
+        manager.start_job(websocket, handle_generate(websocket, action, params, dict(state)))
+    
+    else:
+        await manager.send_json(websocket, {
+            "type": "error",
+            "message": f"Unknown action: {action}",
+            "available_actions": ["ping", "update_params", "set_transport", "set_codec", "set_flow_control", "audio_ack", "have_audio", "resume",
+                                  "join_room", "leave_room",
+                                  "generate_melody", "generate_drums", "generate_both"]
+        })
+
+
+@app.websocket("/ws/spectacles/{client_id}")
+async def websocket_spectacles(websocket: WebSocket, client_id: str):
+    """
+    WebSocket endpoint for Snap Spectacles.
+    
+    Message Protocol:
+    
+    Client → Server:
+    {
+        "action": "generate_melody" | "generate_drums" | "update_params" | "ping",
+        "params": { ... }
+    }
+    
+    Server → Client:
+    {
+        "type": "midi_data" | "status" | "error" | "pong",
+        "data": { ... }
+    }
+    
+    A frame may hold several messages back to back, and a message may be split
+    across frames; they are handled in the order they were sent.
+    
+    Audio is sent as audio_start, audio_chunk..., audio_end. After
+    {"action": "set_transport", "params": {"transport": "binary"}} the chunks
+    arrive as binary frames instead: an 8-byte header (transfer_id, chunk_index;
+    uint32 little-endian) followed by the raw PCM16 bytes.
+    
+    After {"action": "set_flow_control", "params": {"window": 8}} the client
+    acks chunks with {"action": "audio_ack", "params": {"transfer_id": ...,
+    "chunk_index": ...}}; at most `window` chunks are left unacknowledged and
+    chunk sizes follow the measured throughput. audio_end carries the stats.
+    
+    {"action": "set_codec", "params": {"codec": "mulaw" | "ima_adpcm"}} switches
+    the audio payload to a compact codec; see AUDIO CODECS for the decoder spec.
+    
+    A client that lost a transfer (e.g. reconnected with the same client_id)
+    can send {"action": "resume", "params": {"transfer_id": ..., "chunks": [...]}}
+    (or "from_chunk": n) within RESUME_TTL_SECONDS to get just those chunks.
+    
+    audio_start carries the content_hash of the clip. A client that has it
+    cached replies {"action": "have_audio", "params": {"transfer_id": ...,
+    "content_hash": ...}} and the rest of the chunks are skipped; clips it
+    declared that way are afterwards announced with "cached": true and no chunks.
+    
+    generate_drums with "loop_transfer": true (best with "loop_bars": n) sends
+    every distinct bar once: audio_start["loop"] lists the segments (decode each
+    one separately, keep its sample_count) and the arrangement of segment
+    indexes that rebuilds the clip.
+    
+    {"action": "join_room", "params": {"room": "..."}} puts the headset in a
+    room: every clip a member generates is rendered once and sent to all
+    members (room_update lists them). A member that cannot keep up is sent
+    room_evicted and dropped from the room.
+    """
+    await manager.connect(websocket, client_id)
+    
+    # Send welcome message with current state
     await manager.send_json(websocket, {
         "type": "connected",
         "client_id": client_id,
         "state": manager.client_states[client_id],
         "available_scales": list(SCALES.keys()),
-        "available_drum_styles": list(DRUM_PATTERNS.keys())
+        "available_drum_styles": list(DRUM_PATTERNS.keys()),
+        "audio_transports": list(AUDIO_TRANSPORTS),
+        "audio_codecs": {name: codec.describe() for name, codec in AUDIO_CODECS.items()},
+        "binary_chunk_header": {
+            "fields": ["transfer_id", "chunk_index"],
+            "format": "uint32 little-endian",
+            "size": BINARY_CHUNK_HEADER.size
+        }
     })
     
+    decoder = JsonMessageDecoder()
     try:
         while True:
-            # Receive message from Spectacles (handle both text and binary)
+            # Receive a frame from Spectacles (text or binary); it may carry
+            # several messages, or the start of one that the next frame completes
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            
             try:
-                message = await websocket.receive()
-                
-                # Handle different message types
-                if "text" in message:
-                    raw_text = message["text"]
-                elif "bytes" in message:
-                    raw_text = message["bytes"].decode("utf-8")
+                if message.get("text") is not None:
+                    messages, error = decoder.feed(message["text"])
+                elif message.get("bytes") is not None:
+                    messages, error = decoder.feed(message["bytes"])
                 else:
                     print(f"Unknown message type from {client_id}: {message}")
                     continue
-                
-                # Clean the text (remove any trailing garbage and null bytes)
-                raw_text = raw_text.strip().rstrip('\x00')
-                
-                # Handle potential concatenated JSON objects - find first complete object
-                # Look for the end of the first JSON object
-                brace_count = 0
-                end_pos = 0
-                in_string = False
-                escape_next = False
-                
-                for i, char in enumerate(raw_text):
-                    if escape_next:
-                        escape_next = False
-                        continue
-                    if char == '\\' and in_string:
-                        escape_next = True
-                        continue
-                    if char == '"' and not escape_next:
-                        in_string = not in_string
-                        continue
-                    if not in_string:
-                        if char == '{':
-                            brace_count += 1
-                        elif char == '}':
-                            brace_count -= 1
-                            if brace_count == 0:
-                                end_pos = i + 1
-                                break
-                
-                # Extract just the first JSON object
-                if end_pos > 0:
-                    json_text = raw_text[:end_pos]
-                else:
-                    json_text = raw_text
-                
-                # Parse JSON
-                data = json.loads(json_text)
-                
-            except json.JSONDecodeError as e:
-                print(f"JSON decode error from {client_id}: {e}")
-                print(f"Raw message (first 300 chars): {raw_text[:300] if 'raw_text' in dir() else 'N/A'}")
-                await manager.send_json(websocket, {
-                    "type": "error",
-                    "message": f"Invalid JSON: {str(e)}",
-                    "code": "parse_error"
-                })
-                continue
             except Exception as e:
                 print(f"Error receiving message from {client_id}: {e}")
                 await manager.send_json(websocket, {
@@ -996,157 +3549,17 @@ async def websocket_spectacles(websocket: WebSocket, client_id: str):
                 })
                 continue
             
-            action = data.get("action", "")
-            params = data.get("params", {})
-            
-            # Update client state
-            state = manager.client_states.get(client_id, {})
-            
-            if action == "ping":
-                await manager.send_json(websocket, {"type": "pong", "timestamp": datetime.now().isoformat()})
-            
-            elif action == "update_params":
-                # Update stored parameters
-                for key, value in params.items():
-                    if key in state:
-                        state[key] = value
-                manager.client_states[client_id] = state
-                await manager.send_json(websocket, {
-                    "type": "params_updated",
-                    "state": state
-                })
-            
-            elif action == "generate_melody":
-                # Generate melody with current or provided params
-                req = GenerateRequest(
-                    tempo_bpm=params.get("tempo_bpm", state.get("tempo_bpm", 120)),
-                    bars=params.get("bars", 8),
-                    scale=params.get("scale", state.get("scale", "C_major")),
-                    density=params.get("density", state.get("density", 0.55)),
-                    variation=params.get("variation", state.get("variation", 0.35)),
-                    seed=params.get("seed")
-                )
-                
-                await manager.send_json(websocket, {"type": "status", "message": "Generating melody..."})
-                
-                try:
-                    # Generate MIDI file
-                    midi_path = generate_melody_midi(req)
-                    
-                    # Render to PCM16 audio for Spectacles DynamicAudioOutput
-                    await manager.send_json(websocket, {"type": "status", "message": "Rendering audio..."})
-                    pcm_data = generate_audio_pcm16_from_midi(midi_path, sample_rate=48000)
-                    
-                    # Clean up MIDI file
-                    os.unlink(midi_path)
-                    
-                    # Send PCM16 audio in chunks (for DynamicAudioOutput on Spectacles)
-                    await send_audio_chunked(websocket, manager, pcm_data, {
-                        "tempo_bpm": req.tempo_bpm,
-                        "bars": req.bars,
-                        "scale": req.scale,
-                        "density": req.density,
-                        "variation": req.variation
-                    })
-                    print(f"Sent PCM16 audio: {pcm_data['sample_count']} samples @ {pcm_data['sample_rate']}Hz")
-                except Exception as e:
-                    print(f"Error generating melody: {e}")
-                    import traceback
-                    traceback.print_exc()
-                    await manager.send_json(websocket, {"type": "error", "message": str(e)})
-            
-            elif action == "generate_drums":
-                # Generate drums with current or provided params
-                req = DrumifyRequest(
-                    tempo_bpm=params.get("tempo_bpm", state.get("tempo_bpm", 120)),
-                    bars=params.get("bars", 4),
-                    style=params.get("style", state.get("drum_style", "techno")),
-                    swing=params.get("swing", state.get("swing", 0.0)),
-                    seed=params.get("seed")
-                )
-                
-                await manager.send_json(websocket, {"type": "status", "message": "Generating drums..."})
-                
-                try:
-                    # Generate MIDI file
-                    midi_path = generate_drums_midi(req)
-                    
-                    # Render to PCM16 audio for Spectacles DynamicAudioOutput
-                    await manager.send_json(websocket, {"type": "status", "message": "Rendering audio..."})
-                    pcm_data = generate_audio_pcm16_from_midi(midi_path, sample_rate=48000)
-                    
-                    # Clean up MIDI file
-                    os.unlink(midi_path)
-                    
-                    # Send PCM16 audio in chunks (for DynamicAudioOutput on Spectacles)
-                    await send_audio_chunked(websocket, manager, pcm_data, {
-                        "tempo_bpm": req.tempo_bpm,
-                        "bars": req.bars,
-                        "style": req.style,
-                        "swing": req.swing
-                    })
-                    print(f"Sent PCM16 drums: {pcm_data['sample_count']} samples @ {pcm_data['sample_rate']}Hz")
-                except Exception as e:
-                    print(f"Error generating drums: {e}")
-                    import traceback
-                    traceback.print_exc()
-                    await manager.send_json(websocket, {"type": "error", "message": str(e)})
-            
-            elif action == "generate_both":
-                # Generate both melody and drums
-                melody_req = GenerateRequest(
-                    tempo_bpm=params.get("tempo_bpm", state.get("tempo_bpm", 120)),
-                    bars=params.get("bars", 8),
-                    scale=params.get("scale", state.get("scale", "C_major")),
-                    density=params.get("density", state.get("density", 0.55)),
-                    variation=params.get("variation", state.get("variation", 0.35))
-                )
-                drums_req = DrumifyRequest(
-                    tempo_bpm=params.get("tempo_bpm", state.get("tempo_bpm", 120)),
-                    bars=params.get("bars", 8),
-                    style=params.get("style", state.get("drum_style", "techno")),
-                    swing=params.get("swing", state.get("swing", 0.0))
-                )
-                
-                await manager.send_json(websocket, {"type": "status", "message": "Generating melody..."})
-                
-                try:
-                    # Generate melody PCM16
-                    melody_midi_path = generate_melody_midi(melody_req)
-                    await manager.send_json(websocket, {"type": "status", "message": "Rendering melody audio..."})
-                    melody_pcm = generate_audio_pcm16_from_midi(melody_midi_path, sample_rate=48000)
-                    os.unlink(melody_midi_path)
-                    
-                    # Generate drums PCM16
-                    await manager.send_json(websocket, {"type": "status", "message": "Generating drums..."})
-                    drums_midi_path = generate_drums_midi(drums_req)
-                    await manager.send_json(websocket, {"type": "status", "message": "Rendering drums audio..."})
-                    drums_pcm = generate_audio_pcm16_from_midi(drums_midi_path, sample_rate=48000)
-                    os.unlink(drums_midi_path)
-                    
-                    # Send melody in chunks (for now - could mix with drums later)
-                    await send_audio_chunked(websocket, manager, melody_pcm, {
-                        "tempo_bpm": melody_req.tempo_bpm,
-                        "bars": melody_req.bars,
-                        "scale": melody_req.scale,
-                        "drum_style": drums_req.style
-                    })
-                    print(f"Sent PCM16 melody: {melody_pcm['sample_count']} samples")
-                    
-                    # Note: For now we just send melody. 
-                    # Future: Could mix melody + drums into single PCM stream
-                    
-                except Exception as e:
-                    print(f"Error generating both: {e}")
-                    import traceback
-                    traceback.print_exc()
-                    await manager.send_json(websocket, {"type": "error", "message": str(e)})
+            # Messages before a malformed one are still handled, in order
+            for data in messages:
+                await handle_client_message(websocket, client_id, data)
             
-            else:
+            if error is not None:
+                print(f"JSON decode error from {client_id}: {error}")
+                print(f"Raw message (first 300 chars): {error.doc[error.pos:error.pos + 300]}")
                 await manager.send_json(websocket, {
                     "type": "error",
-                    "message": f"Unknown action: {action}",
-                    "available_actions": ["ping", "update_params", "generate_melody", "generate_drums", "generate_both"]
+                    "message": f"Invalid JSON: {str(error)}",
+                    "code": "parse_error"
                 })
     
     except WebSocketDisconnect:
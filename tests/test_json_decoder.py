@@ -0,0 +1,23 @@
+import json
+
+from app import JsonMessageDecoder
+
+
+MESSAGE = '{"action":"update_params","params":{"t":"h\\u00e9 \\ud83d\\ude00","density":0.55,"swing":1.5e-3}}'
+
+
+def test_message_split_at_every_offset():
+    expected = json.loads(MESSAGE)
+    for offset in range(1, len(MESSAGE)):
+        decoder = JsonMessageDecoder()
+        first, first_error = decoder.feed(MESSAGE[:offset])
+        second, second_error = decoder.feed(MESSAGE[offset:])
+        assert (first_error, second_error) == (None, None), offset
+        assert first + second == [expected], offset
+
+
+def test_invalid_escape_is_rejected():
+    decoder = JsonMessageDecoder()
+    messages, error = decoder.feed('{"t":"\\u00zz"}')
+    assert messages == [] and error is not None
+    assert decoder.pending == ""